@@ -1,12 +1,15 @@
 import json
-import random
-from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from simulation import run_analysis, iter_analysis, run_sweep, make_rng, analysis_options, summarize_analysis, STREAM_CHUNK_SIGNALS
+from metrics import Stopwatch
 
 app = Flask(__name__)
 
 @app.route('/analyse', methods=['POST'])
 def analyse():
+    # Compute time is reported back in 'timings' so the coordinator can tell
+    # it apart from network and queueing time
+    watch = Stopwatch()
     event = request.get_json()
 
     # Extracting values from the payload with defaults
@@ -16,56 +19,46 @@ def analyse():
     transaction_type = event.get('t', 'buy')
     check_days = int(event.get('p', 7))
 
-    results = []
-    total_profit_loss = 0
-    total_var95 = 0
-    total_var99 = 0
+    # Optional shard description from the coordinator's partitioner
+    start = event.get('start')
+    stop = event.get('stop')
+    offset = int(event.get('offset', 0))
+    rng = make_rng(event.get('seed'), event.get('stream', 0))
 
-    # Process the data if it exists
-    if data:
-        for i in range(minhistory, len(data)):
-            if data[i][transaction_type.capitalize()] == 1:
-                close_prices = [data[j]['Close'] for j in range(i - minhistory, i)]
-                returns = [(close_prices[k] - close_prices[k - 1]) / close_prices[k - 1] for k in range(1, len(close_prices))]
-                mean = sum(returns) / len(returns)
-                std = (sum((x - mean) ** 2 for x in returns) / len(returns)) ** 0.5
+    # Parameter sweep: one aggregate row per grid combination
+    if 'grid' in event:
+        with watch.span('compute'):
+            table = run_sweep(data, event['grid'], rng)
+        return jsonify({'results': table, 'timings': watch.timings()})
 
-                simulated = [random.gauss(mean, std) for _ in range(shots)]
-                simulated.sort(reverse=True)
-                var95 = simulated[int(len(simulated) * 0.05)]
-                var99 = simulated[int(len(simulated) * 0.01)]
-                total_var95 += var95
-                total_var99 += var99
+    # Streaming mode: one NDJSON line per result as each chunk of signals is
+    # done, then a trailer line holding the averages and timings. Only the
+    # time spent producing rows counts as compute, not the time spent
+    # waiting for the client to read them.
+    if event.get('ndjson'):
+        def generate():
+            results = []
+            rows = iter_analysis(data, minhistory, shots, transaction_type, check_days, rng, start, stop, offset,
+                                 chunk_signals=STREAM_CHUNK_SIGNALS, **analysis_options(event))
+            while True:
+                with watch.span('compute'):
+                    result = next(rows, None)
+                if result is None:
+                    break
+                results.append({key: result[key] for key in ('var95', 'var99', 'profit_loss')})
+                yield json.dumps(result) + '\n'
+            yield json.dumps({'averages': summarize_analysis(results), 'timings': watch.timings()}) + '\n'
 
-                # Calculate profit or loss after specified days
-                future_index = i + check_days
-                profit_loss = None
-                if future_index < len(data):
-                    future_price = data[future_index]['Close']
-                    current_price = data[i]['Close']
-                    profit_loss = (future_price - current_price) / current_price if current_price else None
-                    total_profit_loss += profit_loss if profit_loss else 0
+        return Response(generate(), mimetype='application/x-ndjson')
 
-                results.append({
-                    'signal_date': i,
-                    'var95': var95,
-                    'var99': var99,
-                    'profit_loss': profit_loss,
-                    'type': transaction_type.capitalize()
-                })
-
-    # Calculate averages for audit
-    count_signals = len(results)
-    average_var95 = total_var95 / count_signals if count_signals else 0
-    average_var99 = total_var99 / count_signals if count_signals else 0
+    with watch.span('compute'):
+        results, averages = run_analysis(data, minhistory, shots, transaction_type, check_days, rng, start, stop, offset,
+                                         **analysis_options(event))
 
     return jsonify({
         'results': results,
-        'averages': {
-            'average_var95': average_var95,
-            'average_var99': average_var99,
-            'total_profit_loss': total_profit_loss
-        }
+        'averages': averages,
+        'timings': watch.timings()
     })
 
 if __name__ == '__main__':
@@ -0,0 +1,259 @@
+# Offline benchmark suite for the simulation pipeline. Nothing here touches
+# yfinance, Lambda, EC2 or S3:
+#   - prices are a synthetic GBM series (market_data.synthetic_prices) served
+#     from a temporary fixture directory with MARKET_DATA_OFFLINE=1
+#   - S3 is the local result store (RESULT_STORE_DIR)
+#   - Lambda invoke calls Analysis_Lambda.lambda_handler in-process, with the
+#     request and response sent through JSON as they would be on the wire
+#   - the EC2 worker and the API are driven through their Flask test clients
+#
+#   python benchmarks/pipeline.py [--days 2000] [--shots 1000 10000] [--minhistory 21 101]
+#                                 [--output current.json] [--compare baseline.json --threshold 1.2]
+#
+# The report is one JSON document: a list of benchmarks, each with a stable
+# name and numeric metrics (seconds is the median over --repeat runs,
+# peak_bytes comes from a separate tracemalloc run). --compare prints the
+# ratio of every metric to a previous report and exits with status 1 when a
+# benchmark's time grew by more than --threshold.
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def timed(func, repeat):
+    # Median wall time of func over repeat runs, and its last return value
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        value = func()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times), value
+
+
+def peak_memory(func):
+    # Peak traced allocation (NumPy buffers included) while func runs
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(name, func, repeat, **metrics):
+    seconds, value = timed(func, repeat)
+    entry = {'name': name, 'seconds': seconds, 'peak_bytes': peak_memory(func)}
+    for key, metric in metrics.items():
+        entry[key] = metric(value, seconds)
+    return entry
+
+
+def price_columns(n_days, seed):
+    # Payload columns for a synthetic GBM series of n_days business days
+    # ending today, with the default signal rule applied
+    import pandas as pd
+    from market_data import synthetic_prices
+    from signals import generate_signals
+    from payload import columns_from_frame
+
+    start = (pd.Timestamp.today().normalize() - pd.offsets.BDay(n_days - 1)).strftime('%Y-%m-%d')
+    frame = synthetic_prices(n_days, start=start, seed=seed)
+    generate_signals(frame)
+    return frame, columns_from_frame(frame)
+
+
+def bench_kernel(columns, shots_list, minhistory_list, repeat):
+    from simulation import run_analysis, make_rng
+    from payload import encode_data
+
+    # The payload a worker receives; decoding it is a few NumPy views
+    payload = encode_data(columns)
+    results = []
+    for shots in shots_list:
+        for minhistory in minhistory_list:
+            for t in ('buy', 'sell'):
+                results.append(measure(
+                    f'kernel/t={t}/shots={shots}/minhistory={minhistory}',
+                    lambda: run_analysis(payload, minhistory, shots, t, 7, make_rng(0))[0],
+                    repeat,
+                    signals=lambda rows, seconds: len(rows),
+                    signals_per_sec=lambda rows, seconds: len(rows) / seconds if seconds else None))
+    return results
+
+
+def bench_serialization(columns, repeat):
+    from payload import encode_data, decode_data
+
+    results = []
+    for wire_format, compress in (('json', False), ('binary', False), ('binary', True)):
+        label = f'{wire_format}+zlib' if compress else wire_format
+        encode = lambda: json.dumps(encode_data(columns, wire_format, compress))
+        body = encode()
+        results.append(measure(f'serialization/encode/{label}', encode, repeat,
+                               bytes=lambda value, seconds: len(value)))
+        results.append(measure(f'serialization/decode/{label}', lambda: decode_data(json.loads(body)), repeat))
+    return results
+
+
+def bench_worker(columns, shots, minhistory, repeat):
+    # The EC2 worker's /analyse on one whole payload, buffered and streamed
+    import analysis_script
+    from payload import encode_data
+
+    client = analysis_script.app.test_client()
+    event = {'data': encode_data(columns), 'minhistory': minhistory, 'shots': shots, 't': 'buy', 'p': 7, 'seed': 0}
+
+    def post(body):
+        response = client.post('/analyse', json=body)
+        assert response.status_code == 200, response.status_code
+        return response.get_data()
+
+    return [
+        measure('worker/analyse', lambda: post(event), repeat),
+        measure('worker/analyse-ndjson', lambda: post(dict(event, ndjson=True)), repeat)
+    ]
+
+
+def bench_end_to_end(services, workers, shots, minhistory, repeat):
+    # index.app /analyse through sharding, in-process Lambda workers or the
+    # local process pool, merge and the local result store. peak_bytes only
+    # covers this process, not the pool's workers.
+    import Analysis_Lambda
+    import index
+
+    def invoke_lambda_function(function_name, payload):
+        event = json.loads(json.dumps(payload))
+        return json.loads(Analysis_Lambda.lambda_handler(event, None)['body'])
+
+    index.check_lambda_function = lambda function_name: True
+    index.invoke_lambda_function = invoke_lambda_function
+
+    client = index.app.test_client()
+    # Every repeat must simulate, not read the memo
+    body = {'h': minhistory, 'd': shots, 't': 'buy', 'p': 7, 'seed': 0, 'wait': True, 'cache': False}
+
+    def analyse():
+        index.result_cache.clear()
+        response = client.post('/analyse', json=body)
+        assert response.status_code == 200, response.get_json()
+        return client.get('/get_sig_vars9599').get_json()['var95']
+
+    results = []
+    for service in services:
+        response = client.post('/warmup', json={'s': service, 'r': workers})
+        assert response.status_code == 200, response.get_json()
+        n = response.get_json().get('workers', workers)
+        results.append(measure(f'end_to_end/{service}/workers={n}/shots={shots}/minhistory={minhistory}', analyse, repeat,
+                               signals=lambda rows, seconds: len(rows)))
+    client.get('/terminate')
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline, threshold):
+    # Ratio current/baseline of every shared metric; names of benchmarks
+    # whose time grew by more than threshold
+    previous = {entry['name']: entry for entry in baseline['benchmarks']}
+    regressions = []
+    for entry in report['benchmarks']:
+        old = previous.get(entry['name'])
+        if old is None:
+            continue
+        ratios = {key: value / old[key] for key, value in entry.items()
+                  if isinstance(value, (int, float)) and isinstance(old.get(key), (int, float)) and old[key]}
+        print(entry['name'] + ' ' + ' '.join(f'{key}={ratio:.2f}x' for key, ratio in sorted(ratios.items())), file=sys.stderr)
+        if threshold and ratios.get('seconds', 0) > threshold:
+            regressions.append(entry['name'])
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the simulation pipeline')
+    parser.add_argument('--days', type=int, default=2000, help='length of the synthetic price series')
+    parser.add_argument('--shots', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--minhistory', type=int, nargs='+', default=[21, 101])
+    parser.add_argument('--workers', type=int, default=4, help='Lambda stand-ins for the end-to-end run')
+    parser.add_argument('--service', action='append', choices=['lambda', 'local'], help='end-to-end backends (default: both)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', action='append', choices=['kernel', 'serialization', 'worker', 'end_to_end'])
+    parser.add_argument('--output', help='write the report here instead of stdout')
+    parser.add_argument('--compare', help='previous report to compare against')
+    parser.add_argument('--threshold', type=float, default=None, help='fail when seconds grew by more than this ratio')
+    args = parser.parse_args(argv)
+    suites = args.only or ['kernel', 'serialization', 'worker', 'end_to_end']
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Must be set before market_data, result_store users and index load
+        os.environ.update(MARKET_DATA_OFFLINE='1', MARKET_DATA_FIXTURES=os.path.join(tmp, 'fixtures'),
+                          MARKET_DATA_CACHE=os.path.join(tmp, 'cache'), RESULT_STORE_DIR=os.path.join(tmp, 'store'),
+                          STATE_BACKEND='memory')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+        import numpy as np
+        from market_data import write_fixture
+
+        frame, columns = price_columns(args.days, args.seed)
+        write_fixture('NVDA', frame)
+
+        benchmarks = []
+        if 'kernel' in suites:
+            benchmarks += bench_kernel(columns, args.shots, args.minhistory, args.repeat)
+        if 'serialization' in suites:
+            benchmarks += bench_serialization(columns, args.repeat)
+        if 'worker' in suites:
+            benchmarks += bench_worker(columns, max(args.shots), max(args.minhistory), args.repeat)
+        if 'end_to_end' in suites:
+            benchmarks += bench_end_to_end(args.service or ['lambda', 'local'], args.workers, max(args.shots), max(args.minhistory),
+                                           args.repeat)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'days': args.days,
+            'repeat': args.repeat,
+            'seed': args.seed
+        },
+        'benchmarks': benchmarks
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print('Slower than baseline: ' + ', '.join(regressions), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
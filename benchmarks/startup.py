@@ -0,0 +1,109 @@
+# Cold-start benchmark for the three entry points (index.py, analysis_script.py
+# and Analysis_Lambda.py). Each measurement runs in a fresh interpreter and
+# reports the import time, the latency of the first request and which heavy
+# modules the import pulled in. Runs offline: results go to a temporary
+# RESULT_STORE_DIR and no AWS call is made.
+#
+#   python benchmarks/startup.py [--repeat 5] [--max-import-ms 500]
+#
+# Prints one JSON document; exits with status 1 when an entry point's median
+# import time exceeds --max-import-ms or it loads a module in --forbid.
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['boto3', 'botocore', 'pandas', 'matplotlib', 'yfinance', 'scipy', 'requests']
+
+# First request per entry point: the module is imported under the timer,
+# then the request runs under a second timer.
+FIRST_REQUEST = {
+    'index': "client = module.app.test_client()\n"
+             "response = client.get('/get_endpoints')\n"
+             "assert response.status_code == 200, response.status_code\n",
+    'analysis_script': "client = module.app.test_client()\n"
+                       "response = client.post('/analyse', json=event)\n"
+                       "assert response.status_code == 200, response.status_code\n",
+    'Analysis_Lambda': "response = module.lambda_handler(event, None)\n"
+                       "assert response['statusCode'] == 200, response\n",
+}
+
+CHILD = """
+import importlib, json, sys, time
+sys.path.insert(0, {root!r})
+with open({event_path!r}) as f:
+    event = json.load(f)
+started = time.perf_counter()
+module = importlib.import_module({entry!r})
+imported = time.perf_counter()
+loaded = [name for name in {heavy!r} if name in sys.modules]
+{first_request}
+finished = time.perf_counter()
+print(json.dumps({{'import_ms': (imported - started) * 1000, 'first_request_ms': (finished - imported) * 1000,
+                  'heavy_modules': loaded}}))
+"""
+
+
+def synthetic_event(n_days=400, shots=2000, seed=0):
+    # Small worker payload (record list) on a geometric Brownian motion path
+    rng = random.Random(seed)
+    records = []
+    close = 100.0
+    for day in range(n_days):
+        previous = close
+        close = previous * math.exp(0.0003 + 0.02 * rng.gauss(0, 1))
+        records.append({'Close': close, 'Buy': int(close > previous * 1.01), 'Sell': int(close < previous * 0.99)})
+    return {'data': records, 'minhistory': 101, 'shots': shots, 't': 'buy', 'p': 7, 'seed': seed}
+
+
+def measure(entry, event_path, store_dir):
+    code = CHILD.format(root=ROOT, event_path=event_path, entry=entry, heavy=HEAVY_MODULES,
+                        first_request=FIRST_REQUEST[entry])
+    env = dict(os.environ, RESULT_STORE_DIR=store_dir, MARKET_DATA_OFFLINE='1',
+               AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'))
+    output = subprocess.run([sys.executable, '-c', code], env=env, cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Cold-start benchmark for the API and worker entry points')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--entry', action='append', choices=sorted(FIRST_REQUEST), help='entry point to measure (default: all)')
+    parser.add_argument('--max-import-ms', type=float, help='fail when a median import time is above this')
+    parser.add_argument('--forbid', action='append', default=[], help='fail when an entry point imports this module')
+    args = parser.parse_args(argv)
+
+    report = {'python': sys.version.split()[0], 'repeat': args.repeat, 'entry_points': {}}
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        event_path = os.path.join(tmp, 'event.json')
+        with open(event_path, 'w') as f:
+            json.dump(synthetic_event(), f)
+
+        for entry in args.entry or sorted(FIRST_REQUEST):
+            runs = [measure(entry, event_path, os.path.join(tmp, 'store')) for _ in range(args.repeat)]
+            import_ms = statistics.median(run['import_ms'] for run in runs)
+            report['entry_points'][entry] = {
+                'import_ms': round(import_ms, 1),
+                'first_request_ms': round(statistics.median(run['first_request_ms'] for run in runs), 1),
+                'heavy_modules': runs[-1]['heavy_modules']
+            }
+            if args.max_import_ms is not None and import_ms > args.max_import_ms:
+                failures.append(f'{entry}: import took {import_ms:.0f} ms')
+            for name in set(args.forbid) & set(runs[-1]['heavy_modules']):
+                failures.append(f'{entry}: imports {name}')
+
+    report['failures'] = failures
+    print(json.dumps(report, indent=2))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Charts are drawn with the object-oriented Agg API: every call owns its
+# Figure and canvas, nothing touches pyplot's global state, so concurrent
+# requests can render in parallel and figures are freed with the call.
+
+MAX_POINTS = 2000
+FIGSIZE = (10, 5)
+DPI = 100
+# Bump when the drawing changes so cached images are not reused.
+RENDER_VERSION = 1
+
+
+def lttb(y, threshold):
+    # Largest-Triangle-Three-Buckets downsampling of the series y (x is the
+    # index). Returns the sorted indices of the kept points; the first and
+    # last points are always kept.
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = n - 1
+    a = 0
+    for b in range(threshold - 2):
+        lo, hi = edges[b], edges[b + 1]
+        # Average of the next bucket (the last point for the final bucket)
+        next_lo, next_hi = hi, edges[b + 2] if b + 2 < len(edges) else n
+        avg_x = (next_lo + next_hi - 1) / 2.0
+        avg_y = y[next_lo:next_hi].mean()
+        xs = np.arange(lo, hi)
+        area = np.abs((a - avg_x) * (y[lo:hi] - y[a]) - (a - xs) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        kept[b + 1] = a
+    return kept
+
+
+def downsample(series, max_points=MAX_POINTS):
+    # (x, y) of the series reduced to at most max_points with LTTB
+    y = np.asarray(series, dtype=np.float64)
+    x = lttb(y, max_points)
+    return x, y[x]
+
+
+def chart_key(var95, var99):
+    # Content hash of the plotted series, used as the chart's cache key
+    digest = hashlib.sha256(f'v{RENDER_VERSION}:{MAX_POINTS}'.encode())
+    for series in (var95, var99):
+        values = np.asarray(series, dtype='<f8')
+        digest.update(len(values).to_bytes(8, 'little'))
+        digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+def render_var_chart(var95, var99, max_points=MAX_POINTS):
+    # PNG bytes of the VaR 95%/99% chart
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=FIGSIZE, dpi=DPI)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.plot(*downsample(var95, max_points), label='VaR 95%')
+    ax.plot(*downsample(var99, max_points), label='VaR 99%')
+    ax.legend()
+    ax.set_title('VaR 95% and 99% Over Time')
+
+    buf = io.BytesIO()
+    canvas.print_png(buf)
+    return buf.getvalue()
+
+
+class ChartCache:
+    # Content-addressed chart images. The URL of every uploaded chart is
+    # kept in the shared state (and a small local LRU), so a repeat request
+    # for the same series returns the existing URL without rendering or
+    # uploading again. A per-key lock stops concurrent requests for the same
+    # chart from rendering it twice.
+
+    def __init__(self, result_store, state, max_entries=64):
+        self.result_store = result_store
+        self.state = state
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.mutex = threading.Lock()
+
+    def remember(self, key, url):
+        with self.mutex:
+            self.entries[key] = url
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def lookup(self, key):
+        with self.mutex:
+            url = self.entries.get(key)
+            if url is not None:
+                self.entries.move_to_end(key)
+                return url
+        url = self.state.get(key)
+        if url is not None:
+            self.remember(key, url)
+        return url
+
+    def get_url(self, var95, var99):
+        key = chart_key(var95, var99)
+        url = self.lookup(key)
+        if url is not None:
+            return url
+        with self.state.lock(key):
+            url = self.state.get(key)
+            if url is None:
+                object_key = self.result_store.write_chart(key, render_var_chart(var95, var99))
+                url = self.result_store.url(object_key)
+                self.state.set(key, url)
+        self.remember(key, url)
+        return url
+
+    def clear(self):
+        with self.mutex:
+            self.entries.clear()
@@ -0,0 +1,33 @@
+import threading
+
+
+class LazyClient:
+    # Stand-in for a boto3 client that imports boto3 and creates the real
+    # client on first use, then reuses it for every later call (and across
+    # warm Lambda invocations when held at module level). Entry points pay
+    # nothing at import time for AWS services they never touch.
+
+    def __init__(self, service, region_name=None, max_pool_connections=None):
+        self.service = service
+        self.region_name = region_name
+        self.max_pool_connections = max_pool_connections
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+                    kwargs = {}
+                    if self.region_name:
+                        kwargs['region_name'] = self.region_name
+                    if self.max_pool_connections:
+                        from botocore.config import Config
+                        kwargs['config'] = Config(max_pool_connections=self.max_pool_connections)
+                    self._client = boto3.client(self.service, **kwargs)
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
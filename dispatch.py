@@ -0,0 +1,70 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Upper bound on worker calls in flight at once for a single job
+MAX_CONCURRENCY = 32
+
+_session = None
+_session_lock = threading.Lock()
+
+# instance id -> public DNS name, filled by resolve_instance_dns
+_dns_cache = {}
+_dns_lock = threading.Lock()
+
+
+def get_session():
+    # One pooled requests.Session shared by all EC2 calls, sized so every
+    # concurrent call can keep its own keep-alive connection.
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=MAX_CONCURRENCY, pool_maxsize=MAX_CONCURRENCY)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def resolve_instance_dns(ec2_client, instance_ids):
+    # Public DNS names for the given instances. Unknown ids are looked up
+    # with a single describe_instances call; known ones come from the cache.
+    with _dns_lock:
+        missing = [instance_id for instance_id in instance_ids if not _dns_cache.get(instance_id)]
+        if missing:
+            response = ec2_client.describe_instances(InstanceIds=missing)
+            for reservation in response['Reservations']:
+                for instance in reservation['Instances']:
+                    if instance.get('PublicDnsName'):
+                        _dns_cache[instance['InstanceId']] = instance['PublicDnsName']
+        return [_dns_cache.get(instance_id) for instance_id in instance_ids]
+
+
+def forget_instances(instance_ids=None):
+    with _dns_lock:
+        if instance_ids is None:
+            _dns_cache.clear()
+        for instance_id in instance_ids or []:
+            _dns_cache.pop(instance_id, None)
+
+
+def run_concurrently(func, items, max_workers=MAX_CONCURRENCY, failed=None):
+    # Calls func(item) for every item on a bounded thread pool and yields
+    # (item, result) pairs in completion order. Failed calls are reported
+    # and skipped, and their items appended to `failed` when it is given,
+    # so the caller can retry them or fail the job.
+    items = list(items)
+    if not items:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                yield item, future.result()
+            except Exception as e:
+                print(f"Worker call failed: {e}")
+                if failed is not None:
+                    failed.append(item)
@@ -1,36 +1,111 @@
-import boto3
+import copy
 import json
-import random
-import requests
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
-import yfinance as yf
-import matplotlib.pyplot as plt
-import io
-import base64
+from flask import Flask, Response, request, jsonify
 import time
+from signals import generate_signals
+from partition import plan_shards, plan_sweep_shards, signal_indices, ShardMerger
+from payload import columns_from_frame
+from simulation import SAMPLING_MODES, VAR_METHODS
+from result_store import BUCKET_NAME, open_store, new_run_id
+from result_cache import ResultCache
+from chart import ChartCache
+from jobs import JobManager, JobError
+from state_store import open_state_store
+from dispatch import MAX_CONCURRENCY, get_session, resolve_instance_dns, forget_instances, run_concurrently
+from clients import LazyClient
+from metrics import registry, CONTENT_TYPE
+from scheduler import ShardScheduler, health_snapshot, forget_health
+from local_backend import run_local_shards, warm_pool, shutdown_pool
+from portfolio import parse_basket, portfolio_frame
+from memo import SimulationMemo, series_key, signal_keys
 
 app = Flask(__name__)
 
-# Initialize Boto3 clients for EC2, Lambda, and S3
+# Boto3 clients for EC2, Lambda, and S3, created on first use so that
+# importing the app (an App Engine cold start) does not load boto3
 region_name = 'us-east-1'
-ec2_client = boto3.client('ec2', region_name=region_name)
-lambda_client = boto3.client('lambda', region_name=region_name)
-s3_client = boto3.client('s3')
-
-instance_ids_dict = {
+ec2_client = LazyClient('ec2', region_name=region_name)
+lambda_client = LazyClient('lambda', region_name=region_name, max_pool_connections=MAX_CONCURRENCY)
+s3_client = LazyClient('s3')
+result_store = open_store(BUCKET_NAME, s3_client)
+
+# Session state (warmed-up services, latest results, audit log) and job
+# status live in a shared state store so every gunicorn process sees them.
+# Clients pick a session with the X-Session-Id header.
+state = open_state_store()
+job_state = state.namespace('jobs')
+
+default_instance_ids = {
     'ec2': [],
     'lambda': 'Analysis_Lambda'
 }
 
-analysis_results = {
-    's3_path': None,
-    'results': []
-}
-
-audit_log = []
-start_time = None
-services_initialized = False  # Flag to track if services are initialized
+# Prices used for cost estimates
+EC2_COST_PER_HOUR = 0.0134
+LAMBDA_COST_PER_GB_SECOND = 0.0000166667
+LAMBDA_MEMORY_GB = 1
+
+# Served by /metrics
+stage_seconds = registry.histogram('analyse_stage_seconds', 'Wall time of each job pipeline stage.', ['kind', 'stage'])
+worker_latency_seconds = registry.histogram('worker_latency_seconds', 'Round trip of one shard call, per worker.', ['service', 'worker'])
+worker_compute_seconds = registry.histogram('worker_compute_seconds', 'Compute time reported by the worker for one shard.', ['service', 'worker'])
+shard_retries = registry.counter('shard_retries_total', 'Shard attempts retried after a failure.', ['service'])
+shard_hedges = registry.counter('shard_hedges_total', 'Hedged duplicate attempts sent for straggling shards.', ['service'])
+shard_failures = registry.counter('shard_failures_total', 'Shards that failed on every attempt.', ['service'])
+memo_signals = registry.counter('memo_signals_total', 'Signals of /analyse jobs served from the memo (hit) or simulated (miss).', ['result'])
+
+# EC2 jobs are cut into this many shards per instance so the scheduler can
+# balance them; (connect, read) timeouts of one shard attempt
+EC2_SHARDS_PER_INSTANCE = 4
+EC2_TIMEOUT = (5, 120)
+
+# Invocations of one Lambda shard before the job fails
+LAMBDA_ATTEMPTS = 3
+
+result_cache = ResultCache()
+chart_cache = ChartCache(result_store, state.namespace('charts'))
+memo = SimulationMemo(result_store, state.namespace('memo'))
+
+def publish_job(snapshot):
+    # Job status for every process. A sweep's result table stays with the
+    # in-memory job and in the result store; the snapshot keeps only its
+    # keys, and is deleted when the job is evicted.
+    if snapshot['result'] and 'results' in snapshot['result']:
+        snapshot['result'] = {key: value for key, value in snapshot['result'].items() if key != 'results'}
+    job_state.set(snapshot['job_id'], snapshot)
+
+job_manager = JobManager(publish=publish_job,
+                         on_stage=lambda kind, stage, seconds: stage_seconds.observe(seconds, kind=kind, stage=stage),
+                         on_evict=job_state.delete)
+
+def session_state():
+    return state.namespace(f"session:{request.headers.get('X-Session-Id', 'default')}")
+
+TRANSACTION_TYPES = ('buy', 'sell')
+
+def parse_seed(value):
+    # Request seed: None, or a non-negative integer. Raises ValueError.
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).isdigit():
+        raise ValueError("seed must be a non-negative integer")
+    return int(value)
+
+def parse_target_precision(value):
+    # Early-stopping target: a positive number. Raises ValueError.
+    try:
+        precision = float(value)
+    except (TypeError, ValueError):
+        precision = None
+    if isinstance(value, bool) or precision is None or not 0 < precision < float('inf'):
+        raise ValueError("target_precision must be a positive number")
+    return precision
+
+def session_instances(sess):
+    # The session's services; a fresh copy of the defaults before its first
+    # warmup, so changing it never touches default_instance_ids
+    return sess.get('instance_ids') or copy.deepcopy(default_instance_ids)
 
 def check_lambda_function(function_name):
     try:
@@ -53,30 +128,107 @@ def get_ec2_instance_status(instance_ids):
     statuses = response.get('InstanceStatuses', [])
     return all(status['InstanceState']['Name'] == 'running' for status in statuses)
 
-def invoke_ec2_analysis_script(instance_ids, payload):
-    results = []
-    for instance_id in instance_ids:
-        instance_public_dns = ec2_client.describe_instances(InstanceIds=[instance_id])['Reservations'][0]['Instances'][0]['PublicDnsName']
-        response = requests.post(f'http://{instance_public_dns}:5000/analyse', json=payload)
-        if response.status_code == 200:
-            response_json = response.json()
-            if 'results' in response_json:
-                results.extend(response_json['results'])
-            else:
-                print(f"Missing 'results' key in EC2 response: {response_json}")
-    return results
-
-def save_results_to_s3(results, s3_path):
-    s3_bucket, s3_key = s3_path.replace('s3://', '').split('/', 1)
-    s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=json.dumps(results))
+def invoke_lambda_shards(function_name, payloads, sink, on_shard_done=None):
+    # Invokes one Lambda per shard in parallel and hands each shard's
+    # results to sink(results, shots) as the invocations complete.
+    # on_shard_done gets the shard's round-trip latency and the timings the
+    # worker reported. Failed invocations (e.g. throttling) are retried up
+    # to LAMBDA_ATTEMPTS times; every shard holds its own signals, so the
+    # job fails rather than return a partial result set.
+    def call(payload):
+        started = time.perf_counter()
+        response_payload = invoke_lambda_function(function_name, payload)
+        if 'results' not in response_payload:
+            raise IOError(f"Missing 'results' key in Lambda response: {response_payload}")
+        return response_payload, time.perf_counter() - started
+
+    pending = list(payloads)
+    for attempt in range(LAMBDA_ATTEMPTS):
+        if attempt:
+            shard_retries.inc(len(pending), service='lambda')
+        failed = []
+        for payload, (response_payload, latency) in run_concurrently(call, pending, failed=failed):
+            if on_shard_done:
+                on_shard_done({'service': 'lambda', 'worker': function_name, 'latency': latency,
+                               'timings': response_payload.get('timings', {})})
+            sink(response_payload['results'], payload.get('shots'))
+        pending = failed
+        if not pending:
+            return
+    shard_failures.inc(len(pending), service='lambda')
+    raise JobError(f"{len(pending)} of {len(payloads)} Lambda shards failed after retries", 502)
+
+def post_ec2_shard(session, dns_name, payload):
+    # One attempt at a shard on one instance; returns (rows, timings) or
+    # raises. Analysis shards are read as an NDJSON stream and only count as
+    # complete once the trailer line has arrived, so a worker that dies
+    # mid-stream fails the attempt instead of leaving partial results.
+    url = f'http://{dns_name}:5000/analyse'
+    if 'grid' in payload:
+        response = session.post(url, json=payload, timeout=EC2_TIMEOUT)
+        response.raise_for_status()
+        body = response.json()
+        return body['results'], body.get('timings', {})
+
+    rows = []
+    with session.post(url, json=dict(payload, ndjson=True), stream=True, timeout=EC2_TIMEOUT) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                record = json.loads(line)
+                if 'averages' in record:
+                    return rows, record.get('timings', {})
+                rows.append(record)
+    raise IOError(f"Truncated result stream from {dns_name}")
+
+def invoke_ec2_analysis_script(instance_ids, payloads, sink, on_shard_done=None):
+    # Runs the shards on the EC2 instances through the load-aware
+    # ShardScheduler (work stealing, retries on other instances, hedged
+    # duplicates for stragglers) over the pooled session. Each shard's rows
+    # reach sink(results, shots) once, from the attempt that finished first.
+    dns_names = dict(zip(instance_ids, resolve_instance_dns(ec2_client, instance_ids)))
+    available = [instance_id for instance_id in instance_ids if dns_names[instance_id]]
+    if not available:
+        raise JobError("No EC2 instance has a public DNS name", 500)
+    session = get_session()
+
+    def deliver(payload, outcome, instance_id, latency):
+        rows, timings = outcome
+        sink(rows, payload.get('shots'))
+        if on_shard_done:
+            on_shard_done({'service': 'ec2', 'worker': instance_id, 'latency': latency, 'timings': timings})
+
+    scheduler = ShardScheduler(available, lambda instance_id, payload: post_ec2_shard(session, dns_names[instance_id], payload),
+                               rows=lambda outcome: len(outcome[0]))
+    report = scheduler.run(payloads, deliver)
+    shard_retries.inc(report['retries'], service='ec2')
+    shard_hedges.inc(report['hedges'], service='ec2')
+    if report['failed']:
+        shard_failures.inc(len(report['failed']), service='ec2')
+        raise JobError(f"{len(report['failed'])} of {len(payloads)} EC2 shards failed after retries", 502)
+
+def save_results_to_s3(run_id, results, manifest):
+    # Writes the run's merged results and manifest as new objects and returns
+    # the manifest key
+    return result_store.write_run(run_id, results, manifest)
 
 @app.route('/warmup', methods=['POST'])
 def warmup():
-    global r, start_time, services_initialized
+    sess = session_state()
     data = request.get_json()
     service = data.get('s')
     r = data.get('r', 1)
-    start_time = time.time()
+
+    with sess.lock('warmup'):
+        return warmup_service(sess, service, r)
+
+def warmup_service(sess, service, r):
+    instance_ids_dict = session_instances(sess)
+    sess.set('r', r)
+
+    if service in ('ec2', 'lambda'):
+        instance_ids_dict.pop('local', None)
+        sess.set('instance_ids', instance_ids_dict)
 
     if service == 'ec2':
         image_id = 'ami-0391de34153ad3ef9'
@@ -91,42 +243,60 @@ def warmup():
         )
         instance_ids = [instance['InstanceId'] for instance in response['Instances']]
         instance_ids_dict['ec2'] = instance_ids
-        services_initialized = True
+        sess.set('instance_ids', instance_ids_dict)
+        sess.set('services_initialized', True)
         return jsonify({"result": "ok", "instances": instance_ids})
 
     elif service == 'lambda':
         function_name = instance_ids_dict['lambda']
         if check_lambda_function(function_name):
-            services_initialized = True
+            sess.set('services_initialized', True)
             return jsonify({"result": "ok"})
         else:
             return jsonify({"result": "error", "message": "Lambda function not found"}), 500
 
+    elif service == 'local':
+        # Process pool on this host, one worker per core; r is ignored
+        workers = warm_pool()
+        instance_ids_dict['local'] = workers
+        sess.set('instance_ids', instance_ids_dict)
+        sess.set('r', workers)
+        sess.set('services_initialized', True)
+        return jsonify({"result": "ok", "workers": workers})
+
     return jsonify({"result": "invalid service"}), 400
 
 @app.route('/scaled_ready', methods=['GET'])
 def scaled_ready():
-    if instance_ids_dict['ec2'] and get_ec2_instance_status(instance_ids_dict['ec2']):
-        return jsonify({"warm": True})
+    instance_ids_dict = session_instances(session_state())
+    # Same precedence as service_name(): local, then ec2, then lambda
+    if instance_ids_dict.get('local'):
+        return jsonify({"warm": True, "workers": instance_ids_dict['local']})
+    elif instance_ids_dict['ec2']:
+        if get_ec2_instance_status(instance_ids_dict['ec2']):
+            return jsonify({"warm": True, "instances": health_snapshot(instance_ids_dict['ec2'])})
+        return jsonify({"warm": False})
     elif instance_ids_dict['lambda']:
         return jsonify({"warm": True})
     return jsonify({"warm": False})
 
 @app.route('/get_warmup_cost', methods=['GET'])
 def get_warmup_cost():
-    global r
-    cost_per_hour = 0.0134
-    cost_per_request_lambda = 0.0000166667
-    memory_gb_lambda = 1
+    sess = session_state()
+    instance_ids_dict = session_instances(sess)
+    r = sess.get('r', 1)
     time_seconds_lambda = 1
 
+    if instance_ids_dict.get('local'):
+        return jsonify({"billable_time": 0, "cost": 0})
+
     if instance_ids_dict['ec2']:
         time_seconds = r * 3600
-        cost = r * cost_per_hour
+        cost = r * EC2_COST_PER_HOUR
         return jsonify({"billable_time": time_seconds, "cost": cost})
 
     elif instance_ids_dict['lambda']:
-        cost = r * memory_gb_lambda * time_seconds_lambda * cost_per_request_lambda
+        cost = r * LAMBDA_MEMORY_GB * time_seconds_lambda * LAMBDA_COST_PER_GB_SECOND
         return jsonify({"billable_time": r * time_seconds_lambda, "cost": cost})
 
     return jsonify({"result": "invalid service"}), 400
@@ -138,9 +308,12 @@ def get_endpoints():
     endpoints = [
         {"endpoint": f"curl -X POST -H \"Content-Type: application/json\" -d '{{\"s\": \"ec2\", \"r\": 3}}' {server_address}/warmup"},
         {"endpoint": f"curl -X POST -H \"Content-Type: application/json\" -d '{{\"s\": \"lambda\", \"r\": 3}}' {server_address}/warmup"},
+        {"endpoint": f"curl -X POST -H \"Content-Type: application/json\" -d '{{\"s\": \"local\"}}' {server_address}/warmup"},
         {"endpoint": f"curl -X GET {server_address}/scaled_ready"},
         {"endpoint": f"curl -X GET {server_address}/get_warmup_cost"},
         {"endpoint": f"curl -X POST -H \"Content-Type: application/json\" -d '{{\"h\": 5, \"d\": 10000, \"t\": \"buy\", \"p\": 7}}' {server_address}/analyse"},
+        {"endpoint": f"curl -X POST -H \"Content-Type: application/json\" -d '{{\"h\": [50, 101], \"d\": [1000, 10000], \"t\": [\"buy\", \"sell\"], \"p\": [5, 7]}}' {server_address}/analyse_sweep"},
+        {"endpoint": f"curl -X GET {server_address}/job_status?job_id=<job_id>"},
         {"endpoint": f"curl -X GET {server_address}/get_sig_vars9599"},
         {"endpoint": f"curl -X GET {server_address}/get_avg_vars9599"},
         {"endpoint": f"curl -X GET {server_address}/get_sig_profit_loss"},
@@ -148,6 +321,7 @@ def get_endpoints():
         {"endpoint": f"curl -X GET {server_address}/get_chart_url"},
         {"endpoint": f"curl -X GET {server_address}/get_time_cost"},
         {"endpoint": f"curl -X GET {server_address}/get_audit"},
+        {"endpoint": f"curl -X GET {server_address}/metrics"},
         {"endpoint": f"curl -X GET {server_address}/reset"},
         {"endpoint": f"curl -X GET {server_address}/terminate"},
         {"endpoint": f"curl -X GET {server_address}/scaled_terminated"}
@@ -155,260 +329,468 @@ def get_endpoints():
     
     return jsonify(endpoints)
 
-@app.route('/analyse', methods=['POST'])
-def analyse():
-    global start_time, services_initialized
-    if not services_initialized:
-        return jsonify({"result": "error", "message": "Services not initialized. Please run warmup first."}), 400
-
-    data_input = request.get_json()
-
-    # Extract parameters
-    h = data_input.get('h')
-    d = data_input.get('d')
-    t = data_input.get('t')
-    p = data_input.get('p')
+def prepare_columns(job, data_input, basket=None):
+    # Price history with buy/sell signals as payload columns, timed as the
+    # 'download' and 'signals' stages. market_data pulls in pandas, so it is
+    # imported on the first analysis rather than at startup. With a basket
+    # of (tickers, weights) the signals are read off the portfolio index and
+    # the aligned asset closes are added as the 'Assets' column.
+    from market_data import get_prices, get_prices_many
 
-    # Prepare stock data (this part is specific to your application)
+    job.start_stage('download')
     today = datetime.today()
     past_time = today - timedelta(days=3*365)
-    data = yf.download('NVDA', start=past_time, end=today)
-    data.reset_index(inplace=True)
-    data['Buy'] = 0
-    data['Sell'] = 0
-
-    for i in range(2, len(data)):
-        body = 0.01  # Threshold for price change to consider
-        if (data.loc[i, 'Close'] - data.loc[i, 'Open']) >= body:
-            data.at[i, 'Buy'] = 1 if data.loc[i, 'Close'] > data.loc[i - 1, 'Close'] else data.at[i, 'Buy']
-            data.at[i, 'Sell'] = 1 if data.loc[i, 'Close'] < data.loc[i - 1, 'Close'] else data.at[i, 'Sell']
-
-    data['Date'] = data['Date'].dt.strftime('%Y-%m-%d')
-    simplified_data = data[['Date', 'Close', 'Buy', 'Sell']].to_dict('records')
-
-    payload = {
-        'data': simplified_data,
-        'minhistory': h,
-        'shots': d,
-        't': t,
-        'p': p
-    }
-
-    global analysis_results
-    analysis_results['results'] = []
+    if basket:
+        tickers, weights = basket
+        data, assets = portfolio_frame(get_prices_many(tickers, past_time, today), tickers, weights)
+        if len(data) == 0:
+            raise JobError("The tickers have no trading days in common", 400)
+    else:
+        data = get_prices('NVDA', past_time, today)
+    job.finish_stage('download')
 
-    if instance_ids_dict['lambda']:
-        function_name = instance_ids_dict['lambda']
-        for _ in range(r):
-            response_payload = invoke_lambda_function(function_name, payload)
-            if 'results' in response_payload:
-                analysis_results['results'].extend(response_payload['results'])
-            else:
-                print(f"Missing 'results' key in Lambda response: {response_payload}")
+    job.start_stage('signals')
+    signal_params = data_input.get('signal_params', {})
+    if not isinstance(signal_params, dict):
+        raise JobError("signal_params must be an object", 400)
+    try:
+        generate_signals(data, data_input.get('signal_rule', 'body'), **signal_params)
+    except (ValueError, TypeError) as e:
+        # TypeError: a parameter of the wrong type, e.g. a string for days
+        raise JobError(str(e), 400)
+    columns = columns_from_frame(data)
+    if basket:
+        columns['Assets'] = assets
+    job.finish_stage('signals')
+    return columns
+
+def worker_count(sess):
+    instance_ids_dict = session_instances(sess)
+    if instance_ids_dict.get('local'):
+        return instance_ids_dict['local']
+    if instance_ids_dict['ec2']:
+        return len(instance_ids_dict['ec2']) * EC2_SHARDS_PER_INSTANCE
+    return sess.get('r', 1)
+
+def service_name(sess):
+    instance_ids_dict = session_instances(sess)
+    if instance_ids_dict.get('local'):
+        return 'local'
+    return "ec2" if instance_ids_dict['ec2'] else "lambda"
+
+def payload_format(sess, data_input):
+    # The local backend takes the arrays themselves; remote workers get the
+    # requested wire format
+    if service_name(sess) == 'local':
+        return 'columns'
+    return data_input.get('wire_format', 'binary')
+
+def shard_recorder(job, shards):
+    # on_shard_done callback for a job: keeps each shard's timings in
+    # `shards`, feeds the worker histograms and advances the job's progress
+    def on_shard_done(shard):
+        shards.append(shard)
+        worker_latency_seconds.observe(shard['latency'], service=shard['service'], worker=shard['worker'])
+        if 'compute' in shard['timings']:
+            worker_compute_seconds.observe(shard['timings']['compute'], service=shard['service'], worker=shard['worker'])
+        job.shard_done()
+    return on_shard_done
+
+def worker_usage(shards):
+    # Measured worker time of a job's shards. A Lambda is billed for its
+    # whole invocation, so the worker-reported total (or the round trip for
+    # workers that report nothing) is what the cost is based on.
+    return {
+        'compute_seconds': sum(shard['timings'].get('compute', 0) for shard in shards),
+        'worker_seconds': sum(shard['timings'].get('total', shard['latency']) for shard in shards),
+        'max_latency_seconds': max((shard['latency'] for shard in shards), default=0)
+    }
 
+def estimate_cost(service, worker_seconds):
+    if service == 'local':
+        return 0
+    if service == 'ec2':
+        return (worker_seconds / 3600) * EC2_COST_PER_HOUR
+    return worker_seconds * LAMBDA_MEMORY_GB * LAMBDA_COST_PER_GB_SECOND
+
+def dispatch_payloads(sess, payloads, sink, on_shard_done=None):
+    # Runs the shards on the session's warmed-up service, passing results to
+    # sink(results, shots) as they arrive. Same precedence as
+    # service_name(): local, then ec2, then lambda.
+    instance_ids_dict = session_instances(sess)
+    if instance_ids_dict.get('local'):
+        failed = run_local_shards(payloads, sink, on_shard_done)
+        if failed:
+            shard_failures.inc(failed, service='local')
+            raise JobError(f"{failed} of {len(payloads)} local shards failed", 502)
+        return
     elif instance_ids_dict['ec2']:
         if get_ec2_instance_status(instance_ids_dict['ec2']):
-            results = invoke_ec2_analysis_script(instance_ids_dict['ec2'], payload)
-            analysis_results['results'].extend(results)
-        else:
-            return jsonify({"result": "error", "message": "EC2 instances not running"}), 500
-    else:
-        return jsonify({"result": "invalid service"}), 400
+            return invoke_ec2_analysis_script(instance_ids_dict['ec2'], payloads, sink, on_shard_done)
+        raise JobError("EC2 instances not running", 500)
+    elif instance_ids_dict['lambda']:
+        return invoke_lambda_shards(instance_ids_dict['lambda'], payloads, sink, on_shard_done)
+    raise JobError("invalid service", 400)
+
+def run_analysis_job(job, sess, h, d, t, p, options, data_input, basket=None):
+    # Background pipeline behind /analyse, reporting progress on the job
+    columns = prepare_columns(job, data_input, basket)
+
+    # Seeded requests are reproducible (every signal draws its own stream of
+    # the seed), so signals whose inputs match an earlier run are served
+    # from the memo ("cache": false skips the lookup). Unseeded requests are
+    # always simulated and never memoized. The rest are split into one shard
+    # per worker: r Lambda invocations or one per EC2 instance.
+    job.start_stage('dispatch')
+    run_id = new_run_id()
+    seed = data_input.get('seed')
+    memoize = seed is not None
+    indices = signal_indices(columns, h, t).tolist()
+    series = series_key(h, d, t, p, options, seed, basket[0] if basket else None)
+    keys = signal_keys(columns, indices, h, d, t, p, options, seed)
+    cached = memo.lookup(series, keys) if memoize and data_input.get('cache', True) else {}
+    missing = [i for i, key in zip(indices, keys) if key not in cached]
+    memo_signals.inc(len(indices) - len(missing), result='hit')
+    memo_signals.inc(len(missing), result='miss')
+
+    payloads = []
+    if missing:
+        payloads = plan_shards(columns, h, d, t, p, worker_count(sess), seed, run_id, payload_format(sess, data_input), options,
+                               missing)
+    job.set_shards(len(payloads))
+    merger = ShardMerger()
+    shards = []
+    if payloads:
+        dispatch_payloads(sess, payloads, merger.add, shard_recorder(job, shards))
+    job.finish_stage('dispatch')
+
+    job.start_stage('merge')
+    computed = {row['signal_date']: row for row in merger.rows()}
+    results, result_keys = [], []
+    for i, key in zip(indices, keys):
+        row = dict(cached[key], signal_date=i) if key in cached else computed.get(i)
+        if row is not None:
+            results.append(row)
+            result_keys.append(key)
+    if memoize:
+        memo.store(series, result_keys, results)
 
     # Calculate averages
-    var95_values = [result['var95'] for result in analysis_results['results']]
-    var99_values = [result['var99'] for result in analysis_results['results']]
-    total_profit_loss = sum(result['profit_loss'] for result in analysis_results['results'] if result['profit_loss'] is not None)
+    var95_values = [result['var95'] for result in results]
+    var99_values = [result['var99'] for result in results]
+    total_profit_loss = sum(result['profit_loss'] for result in results if result['profit_loss'] is not None)
 
     average_var95 = sum(var95_values) / len(var95_values) if var95_values else 0
     average_var99 = sum(var99_values) / len(var99_values) if var99_values else 0
 
-    analysis_results['averages'] = {
+    averages = {
         'total_profit_loss': total_profit_loss,
         'average_var95': average_var95,
         'average_var99': average_var99
     }
-
-    combined_results_s3_path = 's3://analyse-result-storage/results/combined_results.json'
-    save_results_to_s3(analysis_results, combined_results_s3_path)
-    analysis_results['s3_path'] = combined_results_s3_path
-
-    end_time = time.time()
-    total_time_seconds = end_time - start_time
-    cost = 0
-
-    if instance_ids_dict['ec2']:
-        cost_per_hour = 0.0134
-        cost = (total_time_seconds / 3600) * len(instance_ids_dict['ec2']) * cost_per_hour
-
-    elif instance_ids_dict['lambda']:
-        cost_per_request_lambda = 0.0000166667
-        memory_gb_lambda = 1
-        time_seconds_lambda = total_time_seconds
-        cost = r * memory_gb_lambda * time_seconds_lambda * cost_per_request_lambda
+    job.finish_stage('merge')
+
+    job.start_stage('store')
+    parameters = {'h': h, 'd': d, 't': t, 'p': p}
+    if basket:
+        parameters.update(tickers=basket[0], weights=basket[1])
+    manifest_key = save_results_to_s3(run_id, results, {
+        'parameters': parameters,
+        'averages': averages
+    })
+    combined_results_s3_path = result_store.uri(manifest_key)
+    result_cache.put(manifest_key, results)
+    job.finish_stage('store')
+
+    # The most recent finished analysis is what the get_* endpoints serve
+    # when no job_id is given
+    sess.set('latest_results', {
+        's3_path': combined_results_s3_path,
+        'manifest_key': manifest_key,
+        'run_id': run_id
+    })
+
+    # Time is measured from the request, cost from the workers' measured
+    # compute time
+    r = sess.get('r', 1)
+    service = service_name(sess)
+    total_time_seconds = time.time() - job.created
+    usage = worker_usage(shards)
+    cost = estimate_cost(service, usage['worker_seconds'])
 
     # Log audit
     audit_entry = {
-        "s": "ec2" if instance_ids_dict['ec2'] else "lambda",
+        "s": service,
         "r": r,
         "h": h,
         "d": d,
         "t": t,
         "p": p,
-        "profit_loss": analysis_results['averages']['total_profit_loss'],
-        "av95": analysis_results['averages']['average_var95'],
-        "av99": analysis_results['averages']['average_var99'],
+        "profit_loss": averages['total_profit_loss'],
+        "av95": averages['average_var95'],
+        "av99": averages['average_var99'],
         "time": total_time_seconds,
-        "cost": cost
+        "cost": cost,
+        "timings": job.timings(),
+        "workers": usage,
+        "memo_hits": len(indices) - len(missing),
+        "job_id": job.id
     }
-    audit_log.append(audit_entry)
+    if basket:
+        audit_entry['tickers'] = basket[0]
+    sess.push('audit_log', audit_entry)
+
+    return {"s3_path": combined_results_s3_path, "manifest_key": manifest_key, "run_id": run_id}
+
+def run_sweep_job(job, sess, grid, data_input):
+    # Background pipeline behind /analyse_sweep
+    columns = prepare_columns(job, data_input)
+
+    job.start_stage('dispatch')
+    run_id = new_run_id()
+    payloads = plan_sweep_shards(columns, grid, worker_count(sess), data_input.get('seed'), run_id, payload_format(sess, data_input))
+    job.set_shards(len(payloads))
+    table = []
+    shards = []
+    dispatch_payloads(sess, payloads, lambda rows, shots: table.extend(rows), shard_recorder(job, shards))
+    job.finish_stage('dispatch')
+
+    job.start_stage('store')
+    table = sorted(table, key=lambda row: (row['t'], row['h'], row['d'], row['p']))
+    manifest_key = save_results_to_s3(run_id, table, {'kind': 'sweep', 'parameters': grid})
+    job.finish_stage('store')
+
+    return {"s3_path": result_store.uri(manifest_key), "manifest_key": manifest_key, "run_id": run_id, "results": table,
+            "workers": worker_usage(shards)}
+
+def job_response(job, data_input):
+    # Job id right away, or with "wait": true the finished job's result
+    if not data_input.get('wait'):
+        return jsonify({"result": "ok", "job_id": job.id, "status_url": f"/job_status?job_id={job.id}"}), 202
+    job.done_event.wait()
+    if job.status == 'failed':
+        return jsonify({"result": "error", "job_id": job.id, "message": job.error['message']}), job.error['status']
+    response = {"result": "ok", "job_id": job.id, "analysis_results_path": {"s3_path": job.result['s3_path']}}
+    if 'results' in job.result:
+        response['results'] = job.result['results']
+    return jsonify(response)
+
+@app.route('/analyse', methods=['POST'])
+def analyse():
+    sess = session_state()
+    if not sess.get('services_initialized', False):
+        return jsonify({"result": "error", "message": "Services not initialized. Please run warmup first."}), 400
+
+    data_input = request.get_json()
+
+    # Extract parameters, with the same defaults as the workers
+    try:
+        h = int(data_input.get('h', 101))
+        d = int(data_input.get('d', 10000))
+        p = int(data_input.get('p', 7))
+    except (TypeError, ValueError):
+        return jsonify({"result": "error", "message": "h, d and p must be integers"}), 400
+    t = str(data_input.get('t', 'buy')).lower()
+    if t not in TRANSACTION_TYPES:
+        return jsonify({"result": "error", "message": "t must be buy or sell"}), 400
+    # A window needs at least two closes for one return, and a signal at
+    # least one draw
+    if h < 2 or d < 1:
+        return jsonify({"result": "error", "message": "h must be at least 2 and d at least 1"}), 400
+
+    # Optional VaR method, plus sampling mode and early-stopping target for
+    # the Monte Carlo method
+    options = {key: data_input[key] for key in ('method', 'sampling', 'target_precision') if data_input.get(key) is not None}
+    if options.get('method', 'montecarlo') not in VAR_METHODS:
+        return jsonify({"result": "error", "message": f"Unknown VaR method: {options['method']}"}), 400
+    if options.get('sampling', 'plain') not in SAMPLING_MODES:
+        return jsonify({"result": "error", "message": f"Unknown sampling mode: {options['sampling']}"}), 400
+    try:
+        data_input['seed'] = parse_seed(data_input.get('seed'))
+        if 'target_precision' in options:
+            options['target_precision'] = parse_target_precision(options['target_precision'])
+    except ValueError as e:
+        return jsonify({"result": "error", "message": str(e)}), 400
+
+    # Optional basket: the VaR is that of the weighted portfolio, from a
+    # correlated Monte Carlo over the tickers' returns
+    basket = None
+    parameters = {'h': h, 'd': d, 't': t, 'p': p, **options}
+    if data_input.get('tickers') is not None:
+        try:
+            basket = parse_basket(data_input['tickers'], data_input.get('weights'))
+        except ValueError as e:
+            return jsonify({"result": "error", "message": str(e)}), 400
+        if options.get('method', 'montecarlo') != 'montecarlo' or options.get('sampling', 'plain') != 'plain' or 'target_precision' in options:
+            return jsonify({"result": "error", "message": "Baskets only support the plain Monte Carlo method"}), 400
+        options['weights'] = basket[1]
+        parameters['tickers'] = basket[0]
+
+    job = job_manager.submit('analyse', parameters, run_analysis_job, sess, h, d, t, p, options, data_input, basket)
+    return job_response(job, data_input)
+
+@app.route('/analyse_sweep', methods=['POST'])
+def analyse_sweep():
+    sess = session_state()
+    if not sess.get('services_initialized', False):
+        return jsonify({"result": "error", "message": "Services not initialized. Please run warmup first."}), 400
 
-    return jsonify({"result": "ok", "analysis_results_path": {"s3_path": combined_results_s3_path}})
+    data_input = request.get_json()
 
-def get_s3_file_content(bucket_name, file_key):
-    obj = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-    return json.loads(obj['Body'].read())
+    # Every parameter may be a single value or a list; the grid is their
+    # Cartesian product
+    defaults = {'h': 101, 'd': 10000, 't': 'buy', 'p': 7}
+    grid = {}
+    for key, default in defaults.items():
+        values = data_input.get(key, default)
+        values = values if isinstance(values, list) else [values]
+        try:
+            grid[key] = [str(value).lower() for value in values] if key == 't' else [int(value) for value in values]
+        except (TypeError, ValueError):
+            return jsonify({"result": "error", "message": "h, d and p must be integers"}), 400
+    if not all(grid.values()):
+        return jsonify({"result": "error", "message": "Every sweep parameter needs at least one value"}), 400
+    if any(t not in TRANSACTION_TYPES for t in grid['t']):
+        return jsonify({"result": "error", "message": "t must be buy or sell"}), 400
+    if any(h < 2 for h in grid['h']) or any(d < 1 for d in grid['d']):
+        return jsonify({"result": "error", "message": "h must be at least 2 and d at least 1"}), 400
+    try:
+        data_input['seed'] = parse_seed(data_input.get('seed'))
+    except ValueError as e:
+        return jsonify({"result": "error", "message": str(e)}), 400
+
+    job = job_manager.submit('sweep', grid, run_sweep_job, sess, grid, data_input)
+    return job_response(job, data_input)
+
+@app.route('/job_status', methods=['GET'])
+def job_status():
+    status = job_state.get(request.args.get('job_id'))
+    if status is None:
+        return jsonify({"result": "error", "message": "Unknown job id"}), 404
+    return jsonify(status)
+
+def get_s3_file_content(manifest_key):
+    return result_store.read_run(manifest_key)
+
+def result_manifest_key():
+    # Manifest of the run named by ?job_id=..., or of the latest analysis
+    job_id = request.args.get('job_id')
+    if job_id:
+        job = job_state.get(job_id)
+        if job is None or job['status'] != 'done' or job['kind'] != 'analyse':
+            return None
+        return job['result']['manifest_key']
+    latest = session_state().get('latest_results')
+    return latest['manifest_key'] if latest else None
+
+def get_result_summary(manifest_key):
+    # Aggregates of a run, read from S3 only on a cache miss
+    return result_cache.get_or_load(manifest_key, lambda: get_s3_file_content(manifest_key)['results'])
 
 @app.route('/get_sig_vars9599', methods=['GET'])
 def get_sig_vars9599():
-    s3_path = analysis_results['s3_path']
-    if not s3_path:
+    manifest_key = result_manifest_key()
+    if not manifest_key:
         return jsonify({"result": "error", "message": "No analysis results available"}), 400
 
-    bucket_name, file_key = s3_path.replace('s3://', '').split('/', 1)
-    content = get_s3_file_content(bucket_name, file_key)
-
-    var95 = [item['var95'] for item in content['results']]
-    var99 = [item['var99'] for item in content['results']]
+    summary = get_result_summary(manifest_key)
 
-    return jsonify({"var95": var95, "var99": var99})
+    return jsonify({"var95": summary['var95'], "var99": summary['var99']})
 
 @app.route('/get_avg_vars9599', methods=['GET'])
 def get_avg_vars9599():
-    s3_path = analysis_results['s3_path']
-    if not s3_path:
+    manifest_key = result_manifest_key()
+    if not manifest_key:
         return jsonify({"result": "error", "message": "No analysis results available"}), 400
 
-    bucket_name, file_key = s3_path.replace('s3://', '').split('/', 1)
-    content = get_s3_file_content(bucket_name, file_key)
+    summary = get_result_summary(manifest_key)
 
-    var95 = [item['var95'] for item in content['results']]
-    var99 = [item['var99'] for item in content['results']]
-
-    avg_var95 = sum(var95) / len(var95) if var95 else 0
-    avg_var99 = sum(var99) / len(var99) if var99 else 0
-
-    return jsonify({"var95": avg_var95, "var99": avg_var99})
+    return jsonify({"var95": summary['avg_var95'], "var99": summary['avg_var99']})
 
 @app.route('/get_sig_profit_loss', methods=['GET'])
 def get_sig_profit_loss():
-    s3_path = analysis_results['s3_path']
-    if not s3_path:
+    manifest_key = result_manifest_key()
+    if not manifest_key:
         return jsonify({"result": "error", "message": "No analysis results available"}), 400
 
-    bucket_name, file_key = s3_path.replace('s3://', '').split('/', 1)
-    content = get_s3_file_content(bucket_name, file_key)
+    summary = get_result_summary(manifest_key)
 
-    profit_loss = [item['profit_loss'] for item in content['results'] if item['profit_loss'] is not None]
-
-    return jsonify({"profit_loss": profit_loss})
+    return jsonify({"profit_loss": summary['profit_loss']})
 
 @app.route('/get_tot_profit_loss', methods=['GET'])
 def get_tot_profit_loss():
-    s3_path = analysis_results['s3_path']
-    if not s3_path:
+    manifest_key = result_manifest_key()
+    if not manifest_key:
         return jsonify({"result": "error", "message": "No analysis results available"}), 400
 
-    bucket_name, file_key = s3_path.replace('s3://', '').split('/', 1)
-    content = get_s3_file_content(bucket_name, file_key)
-
-    profit_loss = sum(item['profit_loss'] for item in content['results'] if item['profit_loss'] is not None)
+    summary = get_result_summary(manifest_key)
 
-    return jsonify({"profit_loss": profit_loss})
+    return jsonify({"profit_loss": summary['total_profit_loss']})
 
 @app.route('/get_chart_url', methods=['GET'])
 def get_chart_url():
-    s3_path = analysis_results['s3_path']
-    if not s3_path:
+    manifest_key = result_manifest_key()
+    if not manifest_key:
         return jsonify({"result": "error", "message": "No analysis results available"}), 400
 
-    bucket_name, file_key = s3_path.replace('s3://', '').split('/', 1)
-    content = get_s3_file_content(bucket_name, file_key)
-
-    var95 = [item['var95'] for item in content['results']]
-    var99 = [item['var99'] for item in content['results']]
-
-    plt.figure(figsize=(10, 5))
-    plt.plot(var95, label='VaR 95%')
-    plt.plot(var99, label='VaR 99%')
-    plt.legend()
-    plt.title('VaR 95% and 99% Over Time')
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    img_base64 = base64.b64encode(buf.getvalue()).decode()
-
-    s3_bucket = bucket_name
-    s3_key = 'results/chart.png'
-    s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=base64.b64decode(img_base64))
+    summary = get_result_summary(manifest_key)
 
-    chart_url = f"https://{s3_bucket}.s3.amazonaws.com/{s3_key}"
+    # Rendered once per distinct VaR series and served from the chart cache
+    # afterwards
+    chart_url = chart_cache.get_url(summary['var95'], summary['var99'])
 
     return jsonify({"url": chart_url})
 
 @app.route('/get_time_cost', methods=['GET'])
 def get_time_cost():
-    global start_time
-    end_time = time.time()
-    total_time_seconds = end_time - start_time
-    cost = 0
-
-    if instance_ids_dict['ec2']:
-        cost_per_hour = 0.0134
-        cost = (total_time_seconds / 3600) * len(instance_ids_dict['ec2']) * cost_per_hour
-
-    elif instance_ids_dict['lambda']:
-        cost_per_request_lambda = 0.0000166667
-        memory_gb_lambda = 1
-        time_seconds_lambda = total_time_seconds
-        cost = r * memory_gb_lambda * time_seconds_lambda * cost_per_request_lambda
+    # Measured time and cost of the session's analyses, from the audit log
+    audit_log = session_state().items('audit_log')
+    total_time_seconds = sum(entry['time'] for entry in audit_log)
+    cost = sum(entry['cost'] for entry in audit_log)
 
     return jsonify({"time": total_time_seconds, "cost": cost})
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Stage, worker latency and worker compute histograms of this process in
+    # the Prometheus text format
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
 @app.route('/get_audit', methods=['GET'])
 def get_audit():
-    return jsonify(audit_log)
+    return jsonify(session_state().items('audit_log'))
 
 @app.route('/reset', methods=['GET'])
 def reset():
-    global analysis_results
-    analysis_results = {
-        's3_path': None,
-        'results': []
-    }
+    session_state().delete('latest_results')
+
+    result_cache.clear()
 
     # Clear the results from the S3 bucket
-    s3_bucket = 'analyse-result-storage'
-    s3_prefix = 'results/'
-    objects_to_delete = s3_client.list_objects_v2(Bucket=s3_bucket, Prefix=s3_prefix)
-    if 'Contents' in objects_to_delete:
-        delete_keys = [{'Key': obj['Key']} for obj in objects_to_delete['Contents']]
-        s3_client.delete_objects(Bucket=s3_bucket, Delete={'Objects': delete_keys})
+    result_store.delete_prefix('results/')
 
     return jsonify({"result": "ok"})
 
 @app.route('/terminate', methods=['GET'])
 def terminate():
-    global services_initialized
-    if instance_ids_dict['ec2']:
-        ec2_client.terminate_instances(InstanceIds=instance_ids_dict['ec2'])
-        instance_ids_dict['ec2'] = []
-    services_initialized = False
+    sess = session_state()
+    with sess.lock('warmup'):
+        instance_ids_dict = session_instances(sess)
+        if instance_ids_dict['ec2']:
+            ec2_client.terminate_instances(InstanceIds=instance_ids_dict['ec2'])
+            forget_instances(instance_ids_dict['ec2'])
+            forget_health(instance_ids_dict['ec2'])
+            instance_ids_dict['ec2'] = []
+            sess.set('instance_ids', instance_ids_dict)
+        if instance_ids_dict.pop('local', None):
+            shutdown_pool()
+            sess.set('instance_ids', instance_ids_dict)
+        sess.set('services_initialized', False)
     return jsonify({"result": "ok"})
 
 @app.route('/scaled_terminated', methods=['GET'])
 def scaled_terminated():
+    instance_ids_dict = session_instances(session_state())
     if not instance_ids_dict['ec2']:
         return jsonify({"terminated": True})
 
@@ -0,0 +1,147 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobError(Exception):
+    # Expected pipeline failure, reported to the client with an HTTP status.
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class Job:
+    # Progress record of one background job: overall status, per-stage
+    # status and timings, shard completion counts and the final result.
+    # Every change is handed to `publish` as a to_dict() snapshot and every
+    # finished stage to on_stage(kind, stage, seconds).
+
+    def __init__(self, kind, parameters, publish=None, on_stage=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.parameters = parameters
+        self.status = 'queued'
+        self.created = time.time()
+        self.finished = None
+        self.stages = OrderedDict()
+        self.shards = {'total': 0, 'done': 0}
+        self.result = None
+        self.error = None
+        self.done_event = threading.Event()
+        self.lock = threading.Lock()
+        self.publish = publish
+        self.on_stage = on_stage
+
+    def changed(self):
+        if self.publish:
+            self.publish(self.to_dict())
+
+    def start_stage(self, name):
+        with self.lock:
+            self.stages[name] = {'status': 'running', 'started': time.time(), 'seconds': None}
+        self.changed()
+
+    def finish_stage(self, name):
+        with self.lock:
+            stage = self.stages[name]
+            stage['status'] = 'done'
+            stage['seconds'] = time.time() - stage['started']
+        if self.on_stage:
+            self.on_stage(self.kind, name, stage['seconds'])
+        self.changed()
+
+    def set_shards(self, total):
+        with self.lock:
+            self.shards = {'total': total, 'done': 0}
+        self.changed()
+
+    def shard_done(self):
+        with self.lock:
+            self.shards['done'] += 1
+        self.changed()
+
+    def timings(self):
+        # Seconds of each finished stage
+        with self.lock:
+            return {name: stage['seconds'] for name, stage in self.stages.items() if stage['seconds'] is not None}
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'job_id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'parameters': self.parameters,
+                'created': self.created,
+                'finished': self.finished,
+                'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                'shards': dict(self.shards),
+                'result': self.result,
+                'error': self.error
+            }
+
+
+class JobManager:
+    # Runs pipeline functions on a bounded background pool so request
+    # threads return immediately. Keeps the most recent max_jobs jobs in
+    # memory; `publish` receives every job snapshot so status can be shared
+    # with other processes, on_stage(kind, stage, seconds) every finished
+    # pipeline stage and on_evict(job_id) the ids of jobs dropped past
+    # max_jobs, so published snapshots can be removed with them.
+
+    def __init__(self, max_workers=4, max_jobs=200, publish=None, on_stage=None, on_evict=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.publish = publish
+        self.on_stage = on_stage
+        self.on_evict = on_evict
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, kind, parameters, func, *args):
+        # func(job, *args) runs in the background; its return value becomes
+        # job.result.
+        job = Job(kind, parameters, self.publish, self.on_stage)
+        job.changed()
+        evicted = []
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.max_jobs:
+                oldest_id = next(iter(self.jobs))
+                if not self.jobs[oldest_id].done_event.is_set():
+                    break
+                self.jobs.popitem(last=False)
+                evicted.append(oldest_id)
+        if self.on_evict:
+            for job_id in evicted:
+                self.on_evict(job_id)
+        self.executor.submit(self._run, job, func, args)
+        return job
+
+    def _run(self, job, func, args):
+        job.status = 'running'
+        job.changed()
+        try:
+            job.result = func(job, *args)
+            job.status = 'done'
+        except JobError as e:
+            job.error = {'message': e.message, 'status': e.status}
+            job.status = 'failed'
+        except Exception as e:
+            job.error = {'message': str(e), 'status': 500}
+            job.status = 'failed'
+        finally:
+            for stage in job.stages.values():
+                if stage['status'] == 'running':
+                    stage['status'] = 'failed'
+            job.finished = time.time()
+            job.changed()
+            job.done_event.set()
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
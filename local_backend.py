@@ -0,0 +1,166 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from simulation import run_analysis, run_sweep, make_rng, analysis_options
+from metrics import Stopwatch
+
+# 'local' service: shards run on a process pool on the API host instead of
+# Lambda or EC2. The shards' price columns are copied once into a single
+# shared-memory block and each task only carries the block's name and the
+# offsets of its arrays, so no price data is pickled to the workers. Every
+# worker rebuilds its returns from the shared closes, which is O(n) and
+# cheaper than shipping them.
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool_size():
+    return os.cpu_count() or 1
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Workers must share this process's resource tracker, or each
+            # one would track the blocks it attaches to as its own and try to
+            # remove them again when it exits
+            resource_tracker.ensure_running()
+            _pool = ProcessPoolExecutor(max_workers=pool_size())
+        return _pool
+
+
+def discard_pool(pool):
+    # Drops a broken pool (a worker died, e.g. killed by the OOM killer) so
+    # the next get_pool() starts a fresh one. Another thread may already
+    # have replaced it.
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def ready(_=None):
+    # Imports (NumPy, the simulation kernel) happen when a worker starts, so
+    # running this once per worker takes them off the first job
+    return os.getpid()
+
+
+def warm_pool():
+    # Starts every worker process; returns the pool size
+    pool = get_pool()
+    list(pool.map(ready, range(pool_size())))
+    return pool_size()
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+class SharedColumns:
+    # One shared-memory block holding the column arrays of every shard.
+    # tasks are the shard payloads with 'data' replaced by the block's name
+    # and each array's (offset, dtype, shape). Shards that share the same
+    # data object (sweep shards) share its copy.
+
+    def __init__(self, payloads):
+        layouts = {}
+        arrays = []
+        size = 0
+        for payload in payloads:
+            data = payload['data']
+            if id(data) in layouts:
+                continue
+            layout = {}
+            for name, values in data.items():
+                values = np.ascontiguousarray(values)
+                size = -(-size // 8) * 8
+                layout[name] = (size, values.dtype.str, list(values.shape))
+                arrays.append((size, values))
+                size += values.nbytes
+            layouts[id(data)] = layout
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for offset, values in arrays:
+            self.shm.buf[offset:offset + values.nbytes] = values.tobytes()
+        self.tasks = [dict(payload, data={'shm': self.shm.name, 'columns': layouts[id(payload['data'])]}) for payload in payloads]
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_shard(task):
+    # Runs in a pool worker: one shard against views of the shared block.
+    # Returns (results, timings, worker).
+    watch = Stopwatch()
+    shm = shared_memory.SharedMemory(name=task['data']['shm'])
+    try:
+        columns = {name: np.ndarray(tuple(shape), dtype=dtype, buffer=shm.buf, offset=offset)
+                   for name, (offset, dtype, shape) in task['data']['columns'].items()}
+        rng = make_rng(task.get('seed'), task.get('stream', 0))
+        with watch.span('compute'):
+            if 'grid' in task:
+                results = run_sweep(columns, task['grid'], rng)
+            else:
+                results, _ = run_analysis(columns, int(task['minhistory']), int(task['shots']), task['t'], int(task['p']), rng,
+                                          task.get('start'), task.get('stop'), int(task.get('offset', 0)), **analysis_options(task))
+        # The views must be gone before the block can be closed
+        del columns
+    finally:
+        shm.close()
+    return results, watch.timings(), f'pid-{os.getpid()}'
+
+
+def run_local_shards(payloads, sink, on_shard_done=None):
+    # Runs the shards on the process pool and hands each shard's results to
+    # sink(results, shots) as they complete. Payloads must carry their data
+    # in the 'columns' wire format. Failed shards are reported and skipped;
+    # returns how many failed, so the caller can fail the job. A pool broken
+    # before the job is replaced; one that breaks during it fails its
+    # remaining shards and is replaced for the next job.
+    pool = get_pool()
+    failed = 0
+    with SharedColumns(payloads) as shared:
+        try:
+            futures = {pool.submit(run_shard, task): payload for task, payload in zip(shared.tasks, payloads)}
+        except BrokenProcessPool:
+            discard_pool(pool)
+            pool = get_pool()
+            futures = {pool.submit(run_shard, task): payload for task, payload in zip(shared.tasks, payloads)}
+        for future in as_completed(futures):
+            payload = futures[future]
+            try:
+                results, timings, worker = future.result()
+            except BrokenProcessPool as e:
+                print(f"Local shard failed: {e}")
+                discard_pool(pool)
+                failed += 1
+                continue
+            except Exception as e:
+                print(f"Local shard failed: {e}")
+                failed += 1
+                continue
+            if on_shard_done:
+                # The worker's own wall time: a shard's wait in the pool
+                # queue behind earlier shards is not its latency
+                on_shard_done({'service': 'local', 'worker': worker, 'latency': timings['total'], 'timings': timings})
+            sink(results, payload.get('shots'))
+    return failed
@@ -0,0 +1,212 @@
+import os
+import threading
+import uuid
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.environ.get('MARKET_DATA_CACHE', os.path.join(BASE_DIR, '.market_data'))
+FIXTURE_DIR = os.environ.get('MARKET_DATA_FIXTURES', os.path.join(BASE_DIR, 'fixtures'))
+OFFLINE = os.environ.get('MARKET_DATA_OFFLINE', '0') == '1'
+
+
+def to_epoch_days(dates):
+    return pd.to_datetime(dates).values.astype('datetime64[D]').astype(np.int64)
+
+
+def from_epoch_days(days):
+    return pd.to_datetime(np.asarray(days, dtype=np.int64).astype('datetime64[D]'))
+
+
+def has_business_days(start_day, end_day):
+    # Whether [start_day, end_day) in epoch days contains a weekday
+    if end_day <= start_day:
+        return False
+    return len(pd.bdate_range(from_epoch_days([start_day])[0], from_epoch_days([end_day - 1])[0])) > 0
+
+
+def synthetic_prices(n_days, start='2020-01-01', s0=100.0, mu=0.0005, sigma=0.02, seed=0):
+    # Geometric Brownian motion daily bars on business days, in the same
+    # shape as the frames returned by MarketDataCache.get_prices.
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(start=start, periods=n_days)
+    log_returns = rng.normal(mu - 0.5 * sigma ** 2, sigma, n_days)
+    closes = s0 * np.exp(np.cumsum(log_returns))
+    opens = closes * np.exp(rng.normal(0, sigma / 2, n_days))
+    return pd.DataFrame({
+        'Date': dates,
+        'Open': opens,
+        'High': np.maximum(opens, closes) * 1.005,
+        'Low': np.minimum(opens, closes) * 0.995,
+        'Close': closes,
+        'Volume': rng.integers(1_000_000, 5_000_000, n_days).astype(np.float64)
+    })
+
+
+def write_fixture(ticker, frame, fixture_dir=FIXTURE_DIR):
+    os.makedirs(fixture_dir, exist_ok=True)
+    frame[['Date'] + COLUMNS].to_csv(os.path.join(fixture_dir, f'{ticker}.csv'), index=False)
+
+
+class MarketDataCache:
+    # Daily bars per ticker, kept in memory and in one .npz file per ticker
+    # on disk. Each entry remembers the [start, end) range it has already
+    # fetched, so repeated requests are served locally and only the missing
+    # leading/trailing days are downloaded. In offline mode the "download"
+    # reads fixtures/<ticker>.csv instead of calling yfinance.
+
+    def __init__(self, cache_dir=CACHE_DIR, fixture_dir=FIXTURE_DIR, offline=OFFLINE):
+        self.cache_dir = cache_dir
+        self.fixture_dir = fixture_dir
+        self.offline = offline
+        self.memory = {}
+        self.lock = threading.Lock()
+
+    def cache_path(self, ticker):
+        return os.path.join(self.cache_dir, f'{ticker}.npz')
+
+    def load(self, ticker):
+        if ticker in self.memory:
+            return self.memory[ticker]
+        path = self.cache_path(ticker)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as stored:
+            entry = {
+                'frame': pd.DataFrame({'Date': from_epoch_days(stored['Date']), **{c: stored[c] for c in COLUMNS}}),
+                'start': int(stored['fetched_start']),
+                'end': int(stored['fetched_end'])
+            }
+        self.memory[ticker] = entry
+        return entry
+
+    def store(self, ticker, entry):
+        self.memory[ticker] = entry
+        os.makedirs(self.cache_dir, exist_ok=True)
+        frame = entry['frame']
+        # Unique per writer, so concurrent processes never share a temp file
+        tmp_path = f'{self.cache_path(ticker)}.{uuid.uuid4().hex}.tmp.npz'
+        np.savez(
+            tmp_path,
+            Date=to_epoch_days(frame['Date']),
+            fetched_start=entry['start'],
+            fetched_end=entry['end'],
+            **{c: frame[c].to_numpy(dtype=np.float64) for c in COLUMNS}
+        )
+        os.replace(tmp_path, self.cache_path(ticker))
+
+    def fetch_many(self, tickers, start_day, end_day):
+        # Bars for [start_day, end_day) in epoch days for every ticker, from
+        # one yfinance download for the whole group. Returns {ticker: frame}.
+        if self.offline:
+            frames = {}
+            for ticker in tickers:
+                path = os.path.join(self.fixture_dir, f'{ticker}.csv')
+                if not os.path.exists(path):
+                    raise FileNotFoundError(f"No market data fixture for {ticker} at {path}")
+                frames[ticker] = pd.read_csv(path, parse_dates=['Date'])
+        else:
+            import yfinance as yf
+            downloaded = yf.download(list(tickers), start=from_epoch_days([start_day])[0], end=from_epoch_days([end_day])[0],
+                                     group_by='ticker', progress=False)
+            frames = {}
+            for ticker in tickers:
+                frame = downloaded
+                multi = isinstance(frame.columns, pd.MultiIndex)
+                if frame.empty or (multi and ticker not in frame.columns.get_level_values(0)
+                                   and ticker not in frame.columns.get_level_values(-1)):
+                    # yfinance returns an empty frame instead of raising when
+                    # a download fails
+                    frames[ticker] = pd.DataFrame({'Date': pd.to_datetime([]), **{name: [] for name in COLUMNS}})
+                    continue
+                if multi:
+                    # (ticker, field) with group_by='ticker'; (field, ticker) in
+                    # some yfinance versions
+                    level = 0 if ticker in frame.columns.get_level_values(0) else 1
+                    frame = frame.xs(ticker, axis=1, level=level)
+                frame = frame.dropna(subset=['Close']).reset_index()
+                frame['Date'] = pd.to_datetime(frame['Date']).dt.tz_localize(None)
+                frames[ticker] = frame
+
+        for ticker, frame in frames.items():
+            frame = frame[['Date'] + COLUMNS]
+            days = to_epoch_days(frame['Date'])
+            frames[ticker] = frame[(days >= start_day) & (days < end_day)].reset_index(drop=True)
+        return frames
+
+    def fetch(self, ticker, start_day, end_day):
+        # Bars for [start_day, end_day) in epoch days.
+        return self.fetch_many([ticker], start_day, end_day)[ticker]
+
+    def get_prices_many(self, tickers, start, end):
+        # get_prices for several tickers. Cached ranges are served locally
+        # and the tickers missing the same range are downloaded together in
+        # one batched request. Returns {ticker: frame}.
+        start_day = int(to_epoch_days([pd.Timestamp(start).normalize()])[0])
+        end_day = int(to_epoch_days([pd.Timestamp(end).normalize()])[0])
+        tickers = list(dict.fromkeys(tickers))
+
+        with self.lock:
+            entries = {ticker: self.load(ticker) for ticker in tickers}
+            missing = {}
+            for ticker, entry in entries.items():
+                if entry is None:
+                    missing.setdefault((start_day, end_day), []).append(ticker)
+                    continue
+                if start_day < entry['start']:
+                    missing.setdefault((start_day, entry['start']), []).append(ticker)
+                if end_day > entry['end']:
+                    missing.setdefault((entry['end'], end_day), []).append(ticker)
+
+            fetched = {}
+            for (lo, hi), group in missing.items():
+                for ticker, frame in self.fetch_many(group, lo, hi).items():
+                    fetched.setdefault(ticker, []).append((lo, hi, frame))
+
+            for ticker, parts in fetched.items():
+                # Ranges that came back with rows count as covered, and so do
+                # empty ones without a business day (weekends), which have
+                # nothing to download. An empty range with business days is
+                # a failed download and is retried on the next call instead
+                # of being cached as a gap.
+                parts = [(lo, hi, frame) for lo, hi, frame in parts if len(frame) or not has_business_days(lo, hi)]
+                if not parts:
+                    continue
+                entry = entries[ticker]
+                frames = [frame for _, _, frame in parts]
+                if entry is not None:
+                    frames.insert(0, entry['frame'])
+                frame = pd.concat(frames, ignore_index=True)
+                frame = frame.drop_duplicates('Date', keep='last').sort_values('Date').reset_index(drop=True)
+                starts = [lo for lo, _, _ in parts] + ([entry['start']] if entry is not None else [])
+                ends = [hi for _, hi, _ in parts] + ([entry['end']] if entry is not None else [])
+                entry = {'frame': frame, 'start': min(starts), 'end': max(ends)}
+                self.store(ticker, entry)
+                entries[ticker] = entry
+
+        frames = {}
+        for ticker, entry in entries.items():
+            if entry is None:
+                raise IOError(f"No market data returned for {ticker}")
+            frame = entry['frame']
+            days = to_epoch_days(frame['Date'])
+            frames[ticker] = frame[(days >= start_day) & (days < end_day)].reset_index(drop=True)
+        return frames
+
+    def get_prices(self, ticker, start, end):
+        # Same rows as yf.download(ticker, start, end).reset_index(), with a
+        # Date column and the OHLCV columns.
+        return self.get_prices_many([ticker], start, end)[ticker]
+
+
+default_cache = MarketDataCache()
+
+
+def get_prices(ticker, start, end):
+    return default_cache.get_prices(ticker, start, end)
+
+
+def get_prices_many(tickers, start, end):
+    return default_cache.get_prices_many(tickers, start, end)
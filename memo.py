@@ -0,0 +1,120 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Content-addressed memo of per-signal analysis results. A signal's result
+# only depends on the closes from its minhistory window up to check_days
+# after it, the request parameters and the seed, so those are hashed into
+# its key and the row index (which moves as the 3-year window slides) is
+# not. A repeat request is served entirely from the memo, and after new
+# trailing days are appended only the new signals (and those whose
+# profit/loss window reached the old end of the data) are simulated again.
+#
+# Entries live in a bounded local LRU. With a result store, the rows of the
+# latest run of each parameter set are also written as one object and its
+# key kept in the shared state, so other API processes and restarts can
+# pick them up. Only seeded requests are memoized: their results are fully
+# determined by the key (see simulation.signal_streams).
+
+MEMO_VERSION = 2
+
+
+def parameters_prefix(minhistory, shots, transaction_type, check_days, options=None, seed=None):
+    return json.dumps([MEMO_VERSION, minhistory, shots, transaction_type, check_days, options or {}, seed],
+                      sort_keys=True).encode()
+
+
+def series_key(minhistory, shots, transaction_type, check_days, options=None, seed=None, tickers=None):
+    # Name of the latest run with these parameters on these tickers,
+    # whatever its data
+    digest = hashlib.sha256(parameters_prefix(minhistory, shots, transaction_type, check_days, options, seed))
+    digest.update(json.dumps(tickers).encode())
+    return digest.hexdigest()
+
+
+def signal_keys(columns, indices, minhistory, shots, transaction_type, check_days, options=None, seed=None):
+    # One key per signal row index, over the parameters and the bytes of the
+    # closes (and basket asset closes) the signal's result is computed from
+    prefix = parameters_prefix(minhistory, shots, transaction_type, check_days, options, seed)
+    closes = np.ascontiguousarray(columns['Close'], dtype='<f8')
+    assets = np.ascontiguousarray(columns['Assets'], dtype='<f8') if 'Assets' in columns else None
+    keys = []
+    for i in np.asarray(indices, dtype=np.int64).tolist():
+        lo, hi = max(0, i - minhistory), min(len(closes), max(i, i + check_days) + 1)
+        digest = hashlib.sha256(prefix)
+        digest.update(closes[lo:hi].tobytes())
+        if assets is not None:
+            digest.update(assets[lo:hi].tobytes())
+        keys.append(digest.hexdigest())
+    return keys
+
+
+class SimulationMemo:
+    # lookup() before dispatching a job, store() with the job's merged rows.
+    # Cached rows keep the signal_date of the run that computed them; the
+    # caller sets the current one.
+
+    def __init__(self, result_store=None, state=None, max_entries=50000):
+        self.result_store = result_store
+        self.state = state
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.mutex = threading.Lock()
+
+    def remember(self, keys, rows):
+        with self.mutex:
+            for key, row in zip(keys, rows):
+                self.entries[key] = row
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def local_hits(self, keys):
+        with self.mutex:
+            hits = {}
+            for key in keys:
+                row = self.entries.get(key)
+                if row is not None:
+                    self.entries.move_to_end(key)
+                    hits[key] = row
+            return hits
+
+    def load_series(self, series):
+        # Rows of the latest stored run of a parameter set into the LRU
+        if self.result_store is None or self.state is None:
+            return
+        object_key = self.state.get(series)
+        if object_key is None:
+            return
+        try:
+            rows = self.result_store.read_memo(object_key)
+        except Exception as e:
+            print(f"Could not read memo {object_key}: {e}")
+            return
+        self.remember([row.pop('_key') for row in rows], rows)
+
+    def lookup(self, series, keys):
+        # {key: cached row} for the keys that are known
+        hits = self.local_hits(keys)
+        if len(hits) < len(set(keys)):
+            self.load_series(series)
+            hits = self.local_hits(keys)
+        return hits
+
+    def store(self, series, keys, rows):
+        # Remembers a run's rows, keys in the same order
+        self.remember(keys, rows)
+        if self.result_store is None or self.state is None or not rows:
+            return
+        name = hashlib.sha256(''.join(keys).encode()).hexdigest()
+        object_key = self.result_store.memo_key(series, name)
+        if self.state.get(series) != object_key:
+            self.result_store.write_memo(object_key, [dict(row, _key=key) for key, row in zip(keys, rows)])
+            self.state.set(series, object_key)
+
+    def clear(self):
+        with self.mutex:
+            self.entries.clear()
@@ -0,0 +1,165 @@
+import threading
+import numpy as np
+from payload import encode_data, slice_columns
+from sketch import decode_counts, sketch_var
+
+
+def signal_indices(columns, minhistory, transaction_type):
+    flags = np.asarray(columns[transaction_type.capitalize()])
+    return np.flatnonzero(flags[minhistory:] == 1) + minhistory
+
+
+def split_signal_ranges(indices, n_ranges, length):
+    # Contiguous [start, stop) row ranges holding roughly the same number of
+    # signals each. Every range starts at a signal, so none is empty.
+    if not len(indices) or n_ranges <= 1:
+        return [(int(indices[0]) if len(indices) else length, length)]
+    n_ranges = min(n_ranges, len(indices))
+    groups = np.array_split(indices, n_ranges)
+    ranges = []
+    for n, group in enumerate(groups):
+        stop = int(groups[n + 1][0]) if n + 1 < len(groups) else length
+        ranges.append((int(group[0]), stop))
+    return ranges
+
+
+def split_shots(shots, n_parts):
+    base, extra = divmod(shots, n_parts)
+    return [base + (1 if n < extra else 0) for n in range(n_parts)]
+
+
+def plan_shards(columns, minhistory, shots, transaction_type, check_days, n_workers, seed=None, run_id=None, wire_format='binary',
+                options=None, indices=None):
+    # Splits one analysis job into n_workers payloads. Signals are split into
+    # contiguous index ranges first; when there are fewer signals than
+    # workers the shot count of each range is split as well. Every shard
+    # carries only the rows it needs (the minhistory window before its first
+    # signal up to check_days after its last one), the offset of those rows
+    # in the full history, its own RNG stream of the job seed and the run id
+    # its output is stored under. `columns` are the arrays from payload.py
+    # and each shard's rows are encoded in the requested wire format. Extra
+    # worker options (e.g. sampling) are copied into every shard. `indices`
+    # restricts the job to a subset of the signals (e.g. the ones missing
+    # from the memo); shards may still cover signals between them.
+    #
+    # Workers draw every signal from its own stream of the seed (see
+    # simulation.signal_streams), so a seeded job gives the same results for
+    # any n_workers. Splitting shots would make them depend on the split, so
+    # it is only done for jobs without a seed of their own.
+    seeded = seed is not None
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    length = len(columns['Close'])
+    if indices is None:
+        indices = signal_indices(columns, minhistory, transaction_type)
+    n_workers = max(1, int(n_workers))
+    ranges = split_signal_ranges(indices, n_workers, length)
+    # Only plain Monte Carlo draws can be split (the sketch path draws plain
+    # normals for the full count); other methods, antithetic/Sobol sampling,
+    # early stopping and baskets shard by signal only
+    options = options or {}
+    montecarlo = (not seeded and options.get('method', 'montecarlo') == 'montecarlo' and options.get('sampling', 'plain') == 'plain'
+                  and options.get('target_precision') is None and 'weights' not in options)
+    shot_parts = max(1, n_workers // len(ranges)) if montecarlo else 1
+    shot_counts = split_shots(shots, shot_parts) if shots >= shot_parts else [shots]
+
+    shards = []
+    for start, stop in ranges:
+        lo = max(0, start - minhistory)
+        hi = min(length, stop + max(check_days, 0))
+        data = encode_data(slice_columns(columns, lo, hi), wire_format)
+        for part_shots in shot_counts:
+            shards.append({
+                'data': data,
+                'minhistory': minhistory,
+                'shots': part_shots,
+                't': transaction_type,
+                'p': check_days,
+                'start': start - lo,
+                'stop': stop - lo,
+                'offset': lo,
+                'seed': seed,
+                'stream': len(shards),
+                'run_id': run_id,
+                'sketch': len(shot_counts) > 1,
+                **options
+            })
+    return shards
+
+
+class ShardMerger:
+    # Incremental version of merge_shard_results: shard results can be added
+    # piece by piece from several threads while workers are still running
+    # (e.g. one streamed row at a time), and rows() returns the merged set.
+
+    def __init__(self):
+        self.merged = {}
+        self.lock = threading.Lock()
+
+    def add(self, results, shots):
+        shots = shots or 0
+        with self.lock:
+            for result in results:
+                key = (result['signal_date'], result['type'])
+                counts = decode_counts(result['sketch']) if 'sketch' in result else None
+                if key not in self.merged:
+                    self.merged[key] = dict(result, _shots=shots, _counts=counts)
+                    continue
+                row = self.merged[key]
+                total = row['_shots'] + shots
+                if row['_counts'] is not None and counts is not None:
+                    row['_counts'] = row['_counts'] + counts
+                elif total:
+                    row['var95'] = (row['var95'] * row['_shots'] + result['var95'] * shots) / total
+                    row['var99'] = (row['var99'] * row['_shots'] + result['var99'] * shots) / total
+                row['_shots'] = total
+                if 'shots' in row and 'shots' in result:
+                    row['shots'] += result['shots']
+
+    def rows(self):
+        # Merged rows ordered by signal_date, with the sketch fields resolved
+        # into VaR values and removed
+        with self.lock:
+            rows = [dict(row) for row in sorted(self.merged.values(), key=lambda row: row['signal_date'])]
+        for row in rows:
+            if row['_counts'] is not None:
+                var95, var99 = sketch_var(row['_counts'][None, :], row['mean'], row['std'])
+                row['var95'], row['var99'] = float(var95[0]), float(var99[0])
+            for field in ('_shots', '_counts', 'sketch', 'mean', 'std'):
+                row.pop(field, None)
+        return rows
+
+
+def merge_shard_results(shard_results):
+    # Combines the per-signal results of all shards into one list ordered by
+    # signal_date. Shards that split the shots of the same signals are
+    # merged into a single row: their quantile sketches are added and VaR
+    # re-read from the merged sketch, or, for results without sketches, the
+    # VaR values are the shot-weighted mean of the shard estimates.
+    merger = ShardMerger()
+    for results, shots in shard_results:
+        merger.add(results, shots)
+    return merger.rows()
+
+
+def plan_sweep_shards(columns, grid, n_workers, seed=None, run_id=None, wire_format='binary'):
+    # Splits a parameter grid into at most n_workers sweep payloads. Each
+    # shard keeps one t value and a contiguous chunk of the h values, and
+    # always the full d and p lists, so the shared-draw and shared-returns
+    # savings of run_sweep apply inside every shard.
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    data = encode_data(columns, wire_format)
+    transaction_types = list(grid['t'])
+    chunks_per_type = max(1, int(n_workers) // max(1, len(transaction_types)))
+    shards = []
+    for transaction_type in transaction_types:
+        for chunk in np.array_split(np.asarray(grid['h'], dtype=np.int64), min(chunks_per_type, len(grid['h']))):
+            shards.append({
+                'data': data,
+                'grid': {'t': [transaction_type], 'h': chunk.tolist(), 'd': list(grid['d']), 'p': list(grid['p'])},
+                'seed': seed,
+                'stream': len(shards),
+                'run_id': run_id
+            })
+    return shards
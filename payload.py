@@ -0,0 +1,110 @@
+import base64
+import zlib
+import numpy as np
+
+# Wire format for the price history sent to the workers. Instead of a list
+# of {Date, Close, Buy, Sell} dicts the payload's 'data' is
+#   {'format': 'columnar-v1', 'n': rows, 'compression': 'zlib' | None,
+#    'Date': epoch days (<i4), 'Close': closes (<f8),
+#    'Buy' / 'Sell': bit-packed flags,
+#    'Assets' (baskets only): row-major (rows, 'k') asset closes (<f8)}
+# with every array base64-encoded so it still travels inside the JSON body
+# of a Lambda invoke or an EC2 POST. A plain list of records is still
+# accepted everywhere as the fallback format. In-process backends use the
+# 'columns' wire format: the NumPy arrays themselves, never serialized.
+FORMAT = 'columnar-v1'
+
+DTYPES = {'Date': '<i4', 'Close': '<f8'}
+FLAGS = ('Buy', 'Sell')
+
+
+def columns_from_frame(frame):
+    # Columns from the coordinator's price DataFrame (datetime Date column).
+    return {
+        'Date': frame['Date'].values.astype('datetime64[D]').astype('<i4'),
+        'Close': frame['Close'].to_numpy(dtype='<f8'),
+        'Buy': frame['Buy'].to_numpy(dtype=np.uint8),
+        'Sell': frame['Sell'].to_numpy(dtype=np.uint8)
+    }
+
+
+def columns_from_records(records):
+    columns = {
+        'Close': np.array([row['Close'] for row in records], dtype='<f8'),
+        'Buy': np.array([row['Buy'] for row in records], dtype=np.uint8),
+        'Sell': np.array([row['Sell'] for row in records], dtype=np.uint8)
+    }
+    # The workers never read dates, so rows without them are accepted
+    if records and 'Date' in records[0]:
+        columns['Date'] = np.array([row['Date'] for row in records], dtype='datetime64[D]').astype('<i4')
+    if records and 'Assets' in records[0]:
+        columns['Assets'] = np.array([row['Assets'] for row in records], dtype='<f8')
+    return columns
+
+
+def columns_to_records(columns):
+    dates = np.asarray(columns['Date']).astype('datetime64[D]').astype(str)
+    records = [
+        {'Date': date, 'Close': close, 'Buy': buy, 'Sell': sell}
+        for date, close, buy, sell in zip(dates.tolist(), columns['Close'].tolist(), columns['Buy'].tolist(), columns['Sell'].tolist())
+    ]
+    if 'Assets' in columns:
+        for record, assets in zip(records, np.asarray(columns['Assets']).tolist()):
+            record['Assets'] = assets
+    return records
+
+
+def slice_columns(columns, start, stop):
+    return {name: values[start:stop] for name, values in columns.items()}
+
+
+def _pack(raw, compress):
+    if compress:
+        raw = zlib.compress(raw)
+    return base64.b64encode(raw).decode('ascii')
+
+
+def _unpack(text, compression):
+    raw = base64.b64decode(text)
+    return zlib.decompress(raw) if compression == 'zlib' else raw
+
+
+def encode_columns(columns, compress=False):
+    encoded = {'format': FORMAT, 'n': len(columns['Close']), 'compression': 'zlib' if compress else None}
+    for name, dtype in DTYPES.items():
+        encoded[name] = _pack(np.ascontiguousarray(columns[name], dtype=dtype).tobytes(), compress)
+    for name in FLAGS:
+        encoded[name] = _pack(np.packbits(np.asarray(columns[name], dtype=bool)).tobytes(), compress)
+    if 'Assets' in columns:
+        encoded['k'] = int(columns['Assets'].shape[1])
+        encoded['Assets'] = _pack(np.ascontiguousarray(columns['Assets'], dtype='<f8').tobytes(), compress)
+    return encoded
+
+
+def encode_data(columns, wire_format='binary', compress=False):
+    if wire_format == 'json':
+        return columns_to_records(columns)
+    if wire_format == 'columns':
+        return columns
+    return encode_columns(columns, compress)
+
+
+def decode_data(data):
+    # Columns for either wire format. Date and Close are read-only views over
+    # the decoded buffers (no per-element parsing); the flags are unpacked
+    # from their bit fields.
+    if isinstance(data, dict) and data.get('format') == FORMAT:
+        n = int(data['n'])
+        compression = data.get('compression')
+        columns = {name: np.frombuffer(_unpack(data[name], compression), dtype=dtype, count=n) for name, dtype in DTYPES.items()}
+        for name in FLAGS:
+            columns[name] = np.unpackbits(np.frombuffer(_unpack(data[name], compression), dtype=np.uint8), count=n)
+        if 'Assets' in data:
+            k = int(data['k'])
+            columns['Assets'] = np.frombuffer(_unpack(data['Assets'], compression), dtype='<f8', count=n * k).reshape(n, k)
+        return columns
+    if isinstance(data, dict) and 'format' not in data and 'Close' in data:
+        return data
+    if isinstance(data, dict):
+        raise ValueError(f"Unsupported data format: {data.get('format')}")
+    return columns_from_records(data)
@@ -0,0 +1,67 @@
+import numpy as np
+
+# Coordinator-side preparation of a multi-ticker basket. The tickers' bars
+# are aligned on their common trading days and combined into a daily
+# rebalanced portfolio index (base 100) with Open and Close columns, so the
+# signal rules, profit/loss and the rest of the pipeline work on the basket
+# exactly as on a single ticker. The aligned asset closes travel alongside
+# it (the 'Assets' column of the payload) for the correlated Monte Carlo
+# kernel in simulation.py.
+
+MAX_TICKERS = 100
+
+
+def parse_basket(tickers, weights=None):
+    # Validated (tickers, weights) from a request; weights default to equal
+    # and are normalised to sum to one. Raises ValueError.
+    if not isinstance(tickers, list) or not tickers or not all(isinstance(t, str) and t for t in tickers):
+        raise ValueError("tickers must be a non-empty list of ticker symbols")
+    tickers = [ticker.upper() for ticker in tickers]
+    if len(set(tickers)) != len(tickers):
+        raise ValueError("tickers must not repeat")
+    if len(tickers) > MAX_TICKERS:
+        raise ValueError(f"At most {MAX_TICKERS} tickers are supported")
+    if weights is None:
+        weights = [1.0] * len(tickers)
+    if not isinstance(weights, list) or len(weights) != len(tickers):
+        raise ValueError("weights must be a list with one weight per ticker")
+    try:
+        weights = np.array(weights, dtype=np.float64)
+    except (TypeError, ValueError):
+        raise ValueError("weights must be numbers")
+    if not np.all(np.isfinite(weights)) or abs(weights.sum()) < 1e-12:
+        raise ValueError("weights must be finite and must not sum to zero")
+    return tickers, (weights / weights.sum()).tolist()
+
+
+def align_frames(frames, tickers):
+    # Dates, opens and closes of the tickers on the days all of them traded;
+    # opens and closes are (days, tickers) float64 matrices
+    merged = None
+    for n, ticker in enumerate(tickers):
+        frame = frames[ticker][['Date', 'Open', 'Close']].rename(columns={'Open': f'Open{n}', 'Close': f'Close{n}'})
+        merged = frame if merged is None else merged.merge(frame, on='Date', how='inner')
+    merged = merged.dropna().sort_values('Date').reset_index(drop=True)
+    opens = merged[[f'Open{n}' for n in range(len(tickers))]].to_numpy(dtype=np.float64)
+    closes = merged[[f'Close{n}' for n in range(len(tickers))]].to_numpy(dtype=np.float64)
+    return merged['Date'], opens, closes
+
+
+def portfolio_frame(frames, tickers, weights):
+    # Price frame of the daily rebalanced basket (Date, Open, Close) and the
+    # aligned asset closes. The index close moves by the weighted simple
+    # returns of the assets, so its window statistics are those of the
+    # portfolio return the simulation draws.
+    import pandas as pd
+
+    dates, opens, closes = align_frames(frames, tickers)
+    weights = np.asarray(weights, dtype=np.float64)
+    index_close = np.full(len(closes), 100.0)
+    index_open = np.full(len(closes), 100.0)
+    if len(closes):
+        index_open[0] = 100.0 * (opens[0] / closes[0]) @ weights
+    if len(closes) > 1:
+        index_close[1:] = 100.0 * np.cumprod(1.0 + (closes[1:] / closes[:-1] - 1.0) @ weights)
+        index_open[1:] = index_close[:-1] * (1.0 + (opens[1:] / closes[:-1] - 1.0) @ weights)
+    frame = pd.DataFrame({'Date': dates.values, 'Open': index_open, 'Close': index_close})
+    return frame, closes
@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+
+
+def summarize_results(results):
+    # Everything the get_* endpoints serve, computed in one pass.
+    var95 = [item['var95'] for item in results]
+    var99 = [item['var99'] for item in results]
+    profit_loss = [item['profit_loss'] for item in results if item['profit_loss'] is not None]
+    return {
+        'var95': var95,
+        'var99': var99,
+        'avg_var95': sum(var95) / len(var95) if var95 else 0,
+        'avg_var99': sum(var99) / len(var99) if var99 else 0,
+        'profit_loss': profit_loss,
+        'total_profit_loss': sum(profit_loss)
+    }
+
+
+class ResultCache:
+    # Bounded LRU of result summaries keyed by the run's manifest key. Run
+    # objects are immutable, so an entry never goes stale; eviction only
+    # bounds memory.
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, key, results):
+        summary = summarize_results(results)
+        with self.lock:
+            self.entries[key] = summary
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return summary
+
+    def get(self, key):
+        with self.lock:
+            summary = self.entries.get(key)
+            if summary is not None:
+                self.entries.move_to_end(key)
+            return summary
+
+    def get_or_load(self, key, load_results):
+        summary = self.get(key)
+        if summary is None:
+            summary = self.put(key, load_results())
+        return summary
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,198 @@
+import gzip
+import json
+import os
+import uuid
+from datetime import datetime
+from clients import LazyClient
+
+BUCKET_NAME = 'analyse-result-storage'
+
+# Layout (every object is written once and never updated):
+#   results/date=YYYYMMDD/run=<run_id>/shard-00000.ndjson.gz  raw worker output
+#   results/date=YYYYMMDD/run=<run_id>/merged.ndjson.gz       coordinator result set
+#   results/date=YYYYMMDD/run=<run_id>/manifest.json          run index
+#   audit/date=YYYYMMDD/run=<run_id>/shard-00000.json         worker audit entry
+#   charts/<content_hash>.png                                 rendered VaR chart
+#   memo/<parameters_hash>/<signals_hash>.ndjson.gz           memoized signal rows (memo.py)
+
+
+class S3Backend:
+    def __init__(self, bucket=BUCKET_NAME, client=None):
+        if client is None:
+            client = LazyClient('s3')
+        self.bucket = bucket
+        self.client = client
+
+    def uri(self, key):
+        return f's3://{self.bucket}/{key}'
+
+    def url(self, key):
+        return f'https://{self.bucket}.s3.amazonaws.com/{key}'
+
+    def put(self, key, body):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=body)
+
+    def get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def list(self, prefix):
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return keys
+
+    def delete(self, keys):
+        for start in range(0, len(keys), 1000):
+            chunk = [{'Key': key} for key in keys[start:start + 1000]]
+            self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': chunk})
+
+
+class LocalBackend:
+    # Filesystem stand-in for S3, used for tests and offline runs.
+
+    def __init__(self, root):
+        self.root = root
+
+    def uri(self, key):
+        return f'file://{os.path.join(self.root, key)}'
+
+    def url(self, key):
+        return self.uri(key)
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def put(self, key, body):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(body if isinstance(body, bytes) else body.encode('utf-8'))
+        os.replace(tmp_path, path)
+
+    def get(self, key):
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+    def list(self, prefix):
+        keys = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                key = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+
+def encode_ndjson(rows):
+    return gzip.compress('\n'.join(json.dumps(row) for row in rows).encode('utf-8'))
+
+
+def decode_ndjson(body):
+    text = gzip.decompress(body).decode('utf-8')
+    return [json.loads(line) for line in text.splitlines() if line]
+
+
+def new_run_id():
+    return f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+class ResultStore:
+    # Append-only result and audit storage. Each worker shard and each
+    # coordinator run writes its own immutable objects under a prefix
+    # partitioned by date and run id, so concurrent writers never race and
+    # the cost of a write does not grow with the stored history.
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def run_prefix(kind, run_id):
+        return f'{kind}/date={run_id[:8]}/run={run_id}/'
+
+    def uri(self, key):
+        return self.backend.uri(key)
+
+    def url(self, key):
+        return self.backend.url(key)
+
+    def write_chart(self, name, png):
+        key = f'charts/{name}.png'
+        self.backend.put(key, png)
+        return key
+
+    @staticmethod
+    def memo_key(series, name):
+        return f'memo/{series}/{name}.ndjson.gz'
+
+    def write_memo(self, key, rows):
+        self.backend.put(key, encode_ndjson(rows))
+        return key
+
+    def read_memo(self, key):
+        return decode_ndjson(self.backend.get(key))
+
+    def write_shard(self, run_id, stream, results):
+        key = f"{self.run_prefix('results', run_id)}shard-{int(stream):05d}.ndjson.gz"
+        self.backend.put(key, encode_ndjson(results))
+        return key
+
+    def write_audit(self, run_id, stream, entry):
+        key = f"{self.run_prefix('audit', run_id)}shard-{int(stream):05d}.json"
+        self.backend.put(key, json.dumps(entry))
+        return key
+
+    def write_run(self, run_id, results, manifest):
+        # Stores the merged result set of a run and then its manifest, which
+        # is what readers look for, so a run only becomes visible once its
+        # results are complete.
+        prefix = self.run_prefix('results', run_id)
+        results_key = f'{prefix}merged.ndjson.gz'
+        self.backend.put(results_key, encode_ndjson(results))
+        manifest = dict(manifest, run_id=run_id, results_key=results_key,
+                        shard_keys=[key for key in self.backend.list(prefix) if '/shard-' in key])
+        manifest_key = f'{prefix}manifest.json'
+        self.backend.put(manifest_key, json.dumps(manifest))
+        return manifest_key
+
+    def read_manifest(self, manifest_key):
+        return json.loads(self.backend.get(manifest_key))
+
+    def read_run(self, manifest_key):
+        # Manifest fields plus the run's 'results' list.
+        manifest = self.read_manifest(manifest_key)
+        if manifest.get('results_key'):
+            results = decode_ndjson(self.backend.get(manifest['results_key']))
+        else:
+            results = [row for key in manifest.get('shard_keys', []) for row in decode_ndjson(self.backend.get(key))]
+        return dict(manifest, results=results)
+
+    def list_runs(self, date=None):
+        prefix = f'results/date={date}/' if date else 'results/'
+        return [key for key in self.backend.list(prefix) if key.endswith('/manifest.json')]
+
+    def read_audit(self, date=None):
+        prefix = f'audit/date={date}/' if date else 'audit/'
+        return [json.loads(self.backend.get(key)) for key in self.backend.list(prefix)]
+
+    def delete_prefix(self, prefix):
+        self.backend.delete(self.backend.list(prefix))
+
+
+def open_store(bucket=BUCKET_NAME, client=None):
+    # RESULT_STORE_DIR switches every reader and writer to a local directory
+    # instead of S3.
+    local_root = os.environ.get('RESULT_STORE_DIR')
+    if local_root:
+        return ResultStore(LocalBackend(local_root))
+    return ResultStore(S3Backend(bucket, client))
@@ -0,0 +1,224 @@
+import threading
+import time
+from collections import deque
+
+# Shard scheduler for the EC2 workers. A job is cut into more shards than
+# there are instances and every instance pulls the next shard as soon as it
+# is free (work stealing), so fast instances take more of the job and a slow
+# one only holds up the shard it is on. Failed shards are retried on other
+# instances, instances that keep failing are benched for a while, and once
+# the queue is empty idle instances send hedged duplicates of shards that
+# have run longer than the HEDGE_PERCENTILE latency of the job's finished
+# shards. The first attempt of a shard to finish wins; later ones are
+# dropped, so every shard is delivered exactly once.
+
+MAX_ATTEMPTS = 3
+HEDGE_PERCENTILE = 0.9
+HEDGE_MIN_COMPLETED = 3
+FAILURES_BEFORE_BENCH = 2
+BENCH_SECONDS = 30.0
+EWMA_ALPHA = 0.3
+
+
+class InstanceHealth:
+    # Running statistics of one instance, kept across jobs
+
+    def __init__(self, instance_id):
+        self.instance_id = instance_id
+        self.completed = 0
+        self.failed = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.throughput = None
+        self.benched_until = 0.0
+
+    def record_success(self, seconds, rows):
+        self.completed += 1
+        self.consecutive_failures = 0
+        self.benched_until = 0.0
+        self.latency = seconds if self.latency is None else EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * self.latency
+        if seconds > 0:
+            rate = rows / seconds
+            self.throughput = rate if self.throughput is None else EWMA_ALPHA * rate + (1 - EWMA_ALPHA) * self.throughput
+
+    def record_failure(self):
+        self.failed += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= FAILURES_BEFORE_BENCH:
+            self.benched_until = time.time() + BENCH_SECONDS
+
+    def healthy(self, now=None):
+        return (now or time.time()) >= self.benched_until
+
+    def to_dict(self):
+        return {
+            'instance_id': self.instance_id,
+            'completed': self.completed,
+            'failed': self.failed,
+            'consecutive_failures': self.consecutive_failures,
+            'latency': self.latency,
+            'throughput': self.throughput,
+            'healthy': self.healthy()
+        }
+
+
+_health = {}
+_health_lock = threading.Lock()
+
+
+def instance_health(instance_id):
+    with _health_lock:
+        health = _health.get(instance_id)
+        if health is None:
+            health = _health[instance_id] = InstanceHealth(instance_id)
+        return health
+
+
+def health_snapshot(instance_ids=None):
+    with _health_lock:
+        ids = list(_health) if instance_ids is None else instance_ids
+        return [_health[instance_id].to_dict() for instance_id in ids if instance_id in _health]
+
+
+def forget_health(instance_ids=None):
+    with _health_lock:
+        if instance_ids is None:
+            _health.clear()
+        for instance_id in instance_ids or []:
+            _health.pop(instance_id, None)
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ShardScheduler:
+    # call(instance_id, shard) runs one attempt and returns its outcome or
+    # raises; rows(outcome) is the number of result rows, used for the
+    # throughput statistics. run() blocks until every shard is delivered or
+    # has failed MAX_ATTEMPTS times.
+
+    def __init__(self, instance_ids, call, rows=len, max_attempts=MAX_ATTEMPTS, hedge_percentile=HEDGE_PERCENTILE,
+                 hedge_min_completed=HEDGE_MIN_COMPLETED):
+        self.instance_ids = list(instance_ids)
+        self.call = call
+        self.rows = rows
+        self.max_attempts = max_attempts
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_completed = hedge_min_completed
+        self.cond = threading.Condition()
+
+    def run(self, shards, on_result):
+        # on_result(shard, outcome, instance_id, seconds) is called once per
+        # shard, from the thread of the attempt that won. Returns a report
+        # with the indices of failed shards and the retry and hedge counts.
+        self.shards = list(shards)
+        self.on_result = on_result
+        self.pending = deque(range(len(self.shards)))
+        self.attempts = [0] * len(self.shards)
+        self.excluded = [set() for _ in self.shards]
+        self.in_flight = {}
+        self.hedged = set()
+        self.done = set()
+        self.delivered = set()
+        self.failed = set()
+        self.latencies = []
+        self.retries = 0
+        self.hedges = 0
+
+        threads = [threading.Thread(target=self.work, args=(instance_id,), daemon=True) for instance_id in self.instance_ids]
+        for thread in threads:
+            thread.start()
+        with self.cond:
+            while not self.finished():
+                self.cond.wait(0.5)
+        # Losing hedged attempts keep running in the background and are
+        # discarded when they return.
+        return {'failed': sorted(self.failed), 'retries': self.retries, 'hedges': self.hedges}
+
+    def finished(self):
+        return len(self.delivered) + len(self.failed) == len(self.shards)
+
+    def next_task(self, instance_id):
+        # Next pending shard this instance has not already failed (unless no
+        # other instance could take it), else a straggler to hedge
+        for index in self.pending:
+            if instance_id not in self.excluded[index] or len(self.excluded[index]) >= len(self.instance_ids):
+                self.pending.remove(index)
+                return index
+        if self.pending or len(self.latencies) < self.hedge_min_completed:
+            return None
+
+        threshold = percentile(self.latencies, self.hedge_percentile)
+        now = time.perf_counter()
+        stragglers = [(now - started, index) for index, attempts in self.in_flight.items()
+                      for other, started in attempts
+                      if index not in self.hedged and other != instance_id and len(attempts) == 1 and now - started > threshold]
+        if not stragglers:
+            return None
+        _, index = max(stragglers)
+        self.hedged.add(index)
+        self.hedges += 1
+        return index
+
+    def work(self, instance_id):
+        health = instance_health(instance_id)
+        while True:
+            with self.cond:
+                while True:
+                    if self.finished():
+                        return
+                    benched = not health.healthy() and any(instance_health(other).healthy()
+                                                            for other in self.instance_ids if other != instance_id)
+                    index = None if benched else self.next_task(instance_id)
+                    if index is not None:
+                        break
+                    self.cond.wait(0.05)
+                self.attempts[index] += 1
+                started = time.perf_counter()
+                self.in_flight.setdefault(index, []).append((instance_id, started))
+
+            try:
+                outcome = self.call(instance_id, self.shards[index])
+                error = None
+            except Exception as e:
+                outcome, error = None, e
+            seconds = time.perf_counter() - started
+
+            with self.cond:
+                attempts = self.in_flight.get(index, [])
+                if (instance_id, started) in attempts:
+                    attempts.remove((instance_id, started))
+                if not attempts:
+                    self.in_flight.pop(index, None)
+
+                if error is None:
+                    health.record_success(seconds, self.rows(outcome))
+                    won = index not in self.done and index not in self.failed
+                    if won:
+                        self.done.add(index)
+                        self.latencies.append(seconds)
+                else:
+                    won = False
+                    health.record_failure()
+                    print(f"EC2 shard {index} failed on {instance_id}: {error}")
+                    if index not in self.done and index not in self.failed and index not in self.in_flight:
+                        self.excluded[index].add(instance_id)
+                        if self.attempts[index] < self.max_attempts:
+                            self.retries += 1
+                            self.pending.appendleft(index)
+                        else:
+                            self.failed.add(index)
+                self.cond.notify_all()
+
+            if won:
+                try:
+                    self.on_result(self.shards[index], outcome, instance_id, seconds)
+                    delivered = True
+                except Exception as e:
+                    print(f"EC2 shard {index} could not be merged: {e}")
+                    delivered = False
+                with self.cond:
+                    (self.delivered if delivered else self.failed).add(index)
+                    self.cond.notify_all()
@@ -0,0 +1,61 @@
+import inspect
+
+import numpy as np
+
+# Registered signal rules. Each rule takes the Open and Close columns as
+# float64 arrays plus its own keyword parameters and returns boolean
+# (buy, sell) masks of the same length, computed with column operations.
+SIGNAL_RULES = {}
+
+
+def register_signal_rule(name):
+    def decorator(func):
+        SIGNAL_RULES[name] = func
+        return func
+    return decorator
+
+
+@register_signal_rule('body')
+def body_rule(opens, closes, body=0.01, start=2):
+    # Candle body of at least `body` with a close above (Buy) or below
+    # (Sell) the previous close. Rows before `start` never signal.
+    prev_close = np.empty_like(closes)
+    prev_close[0] = np.nan
+    prev_close[1:] = closes[:-1]
+    candle = (closes - opens) >= body
+    buy = candle & (closes > prev_close)
+    sell = candle & (closes < prev_close)
+    buy[:start] = False
+    sell[:start] = False
+    return buy, sell
+
+
+@register_signal_rule('consecutive')
+def consecutive_rule(opens, closes, days=3):
+    # `days` consecutive higher closes (Buy) or lower closes (Sell).
+    change = np.sign(np.diff(closes, prepend=np.nan))
+    buy = np.ones(len(closes), dtype=bool)
+    sell = np.ones(len(closes), dtype=bool)
+    for lag in range(days):
+        shifted = np.full(len(closes), np.nan)
+        shifted[lag:] = change[:len(closes) - lag]
+        buy &= shifted > 0
+        sell &= shifted < 0
+    return buy, sell
+
+
+def generate_signals(data, rule='body', **params):
+    # Adds integer Buy/Sell columns to the price DataFrame using the named
+    # rule and returns it. Unknown rules and parameters raise ValueError.
+    if rule not in SIGNAL_RULES:
+        raise ValueError(f"Unknown signal rule: {rule}")
+    accepted = list(inspect.signature(SIGNAL_RULES[rule]).parameters)[2:]
+    unknown = sorted(set(params) - set(accepted))
+    if unknown:
+        raise ValueError(f"Unknown parameters for signal rule {rule}: {', '.join(unknown)} (accepted: {', '.join(accepted)})")
+    opens = data['Open'].to_numpy(dtype=np.float64)
+    closes = data['Close'].to_numpy(dtype=np.float64)
+    buy, sell = SIGNAL_RULES[rule](opens, closes, **params)
+    data['Buy'] = buy.astype(int)
+    data['Sell'] = sell.astype(int)
+    return data
@@ -0,0 +1,469 @@
+import hashlib
+from statistics import NormalDist
+import numpy as np
+from payload import decode_data
+from sketch import sketch_normal, sketch_var, encode_counts
+
+# Upper bound on the number of simulated values held in memory at once
+# (signals x shots). 4M float64 values is ~32MB per batch.
+MAX_BATCH_VALUES = 4_000_000
+
+
+def tail_quantiles(simulated):
+    # Reproduces the original "sort descending, read index int(n * 0.05) and
+    # int(n * 0.01)" rule, but with a partial selection along the shots axis
+    # instead of a full sort.
+    shots = simulated.shape[1]
+    k95 = shots - 1 - int(shots * 0.05)
+    k99 = shots - 1 - int(shots * 0.01)
+    selected = np.partition(simulated, (k95, k99), axis=1)
+    return selected[:, k95], selected[:, k99]
+
+
+def simulate_var_multi(means, stds, shot_counts, rng=None):
+    # Like simulate_var for several shot counts at once: the largest count is
+    # drawn once and every smaller count reads its quantiles from the first
+    # `shots` columns of the same draws. Returns {shots: (var95, var99)}.
+    rng = rng if rng is not None else np.random.default_rng()
+    means = np.asarray(means, dtype=np.float64)
+    stds = np.asarray(stds, dtype=np.float64)
+    shot_counts = sorted(set(int(shots) for shots in shot_counts))
+    out = {shots: (np.full(len(means), np.nan), np.full(len(means), np.nan)) for shots in shot_counts}
+    max_shots = shot_counts[-1] if shot_counts else 0
+    if max_shots <= 0:
+        return out
+
+    batch = max(1, MAX_BATCH_VALUES // max_shots)
+    for start in range(0, len(means), batch):
+        stop = min(start + batch, len(means))
+        simulated = rng.standard_normal((stop - start, max_shots))
+        simulated *= stds[start:stop, None]
+        simulated += means[start:stop, None]
+        for shots in shot_counts:
+            if shots > 0:
+                var95, var99 = out[shots]
+                var95[start:stop], var99[start:stop] = tail_quantiles(simulated[:, :shots])
+    return out
+
+
+def simulate_var(means, stds, shots, rng=None):
+    # Draw all shots for a batch of signals as one matrix and return the
+    # VaR95 and VaR99 arrays, one entry per signal.
+    return simulate_var_multi(means, stds, [shots], rng)[int(shots)]
+
+
+SAMPLING_MODES = ('plain', 'antithetic', 'sobol')
+
+# Shots per batch in adaptive runs (a power of two keeps Sobol points
+# balanced) and the number of batches before the stopping rule is checked
+ADAPTIVE_BATCH_SHOTS = 1024
+ADAPTIVE_MIN_BATCHES = 4
+
+
+def standard_normal_block(rng, rows, shots, sampling='plain'):
+    # (rows x shots) standard normal draws. 'antithetic' pairs every draw with
+    # its negation; 'sobol' maps a freshly scrambled Sobol sequence (one
+    # dimension per row) through the normal quantile function, so separate
+    # blocks are independent randomised QMC replications.
+    if sampling == 'antithetic':
+        half = rng.standard_normal((rows, (shots + 1) // 2))
+        return np.concatenate((half, -half), axis=1)[:, :shots]
+    if sampling == 'sobol':
+        from scipy.stats import norm, qmc
+        points = qmc.Sobol(d=rows, scramble=True, seed=rng).random_base2(int(np.ceil(np.log2(max(shots, 1)))))
+        return norm.ppf(points[:shots]).T
+    if sampling != 'plain':
+        raise ValueError(f"Unknown sampling mode: {sampling}")
+    return rng.standard_normal((rows, shots))
+
+
+def simulate_var_adaptive(means, stds, max_shots, rng=None, sampling='plain', target_precision=None):
+    # VaR95/VaR99 drawn in batches of ADAPTIVE_BATCH_SHOTS with the given
+    # sampling mode. With a target_precision (absolute half-width of the 95%
+    # confidence interval, in return units) a signal stops drawing once both
+    # intervals are that tight, estimated from the spread of the per-batch
+    # quantiles; otherwise, and at the latest, it stops at max_shots.
+    # Returns var95, var99 and the shots used per signal.
+    rng = rng if rng is not None else np.random.default_rng()
+    means = np.asarray(means, dtype=np.float64)
+    stds = np.asarray(stds, dtype=np.float64)
+    n_signals = len(means)
+    var95 = np.full(n_signals, np.nan)
+    var99 = np.full(n_signals, np.nan)
+    used = np.zeros(n_signals, dtype=np.int64)
+    if max_shots <= 0 or n_signals == 0:
+        return var95, var99, used
+
+    rows_per_batch = max(1, MAX_BATCH_VALUES // max_shots)
+    for start in range(0, n_signals, rows_per_batch):
+        stop = min(start + rows_per_batch, n_signals)
+        rows = stop - start
+        z = np.empty((rows, max_shots))
+        filled = np.zeros(rows, dtype=np.int64)
+        batch_q95 = []
+        batch_q99 = []
+        active = np.arange(rows)
+        while len(active):
+            offset = filled[active[0]]
+            shots = min(ADAPTIVE_BATCH_SHOTS, max_shots - offset)
+            block = standard_normal_block(rng, len(active), shots, sampling)
+            z[active, offset:offset + shots] = block
+            filled[active] += shots
+            q95, q99 = tail_quantiles(block)
+            batch_q95.append(np.full(rows, np.nan))
+            batch_q99.append(np.full(rows, np.nan))
+            batch_q95[-1][active] = q95
+            batch_q99[-1][active] = q99
+
+            done = filled[active] >= max_shots
+            if target_precision is not None and len(batch_q95) >= ADAPTIVE_MIN_BATCHES:
+                k = len(batch_q95)
+                scale = 1.96 * stds[start:stop][active] / np.sqrt(k)
+                half95 = np.std(np.array(batch_q95)[:, active], axis=0, ddof=1) * scale
+                half99 = np.std(np.array(batch_q99)[:, active], axis=0, ddof=1) * scale
+                done |= (half95 <= target_precision) & (half99 <= target_precision)
+            active = active[~done]
+
+        # Pooled quantiles over all draws each signal kept, grouped by count
+        for count in np.unique(filled):
+            group = np.flatnonzero(filled == count)
+            q95, q99 = tail_quantiles(z[group, :count])
+            var95[start + group] = means[start + group] + stds[start + group] * q95
+            var99[start + group] = means[start + group] + stds[start + group] * q99
+        used[start:stop] = filled
+    return var95, var99, used
+
+
+class RollingReturns:
+    # Simple returns of a close series with prefix sums of the first two
+    # moments, so the mean and population std of any window of returns come
+    # out in O(1). Returns are shifted by their global mean before summing to
+    # keep the E[x^2] - E[x]^2 difference well conditioned.
+
+    def __init__(self, closes):
+        closes = np.asarray(closes, dtype=np.float64)
+        self.closes = closes
+        self.returns = np.diff(closes) / closes[:-1]
+        self.shift = self.returns.mean() if len(self.returns) else 0.0
+        centred = self.returns - self.shift
+        self.sum1 = np.concatenate(([0.0], np.cumsum(centred)))
+        self.sum2 = np.concatenate(([0.0], np.cumsum(centred * centred)))
+
+    def window_stats(self, end_indices, minhistory):
+        # Statistics of the returns built from closes[i - minhistory:i], i.e.
+        # returns[i - minhistory:i - 1], for every i in end_indices.
+        end_indices = np.asarray(end_indices, dtype=np.int64)
+        count = minhistory - 1
+        lo = end_indices - minhistory
+        hi = end_indices - 1
+        s1 = self.sum1[hi] - self.sum1[lo]
+        s2 = self.sum2[hi] - self.sum2[lo]
+        centred_mean = s1 / count
+        if count == 1:
+            # A single return has no spread; the subtraction below would
+            # leave rounding noise of the prefix sums instead of zero
+            return centred_mean + self.shift, np.zeros(len(end_indices))
+        variance = np.maximum(s2 / count - centred_mean * centred_mean, 0.0)
+        return centred_mean + self.shift, np.sqrt(variance)
+
+
+def window_stats(closes, signal_indices, minhistory):
+    # Mean and population std of the simple returns over the minhistory
+    # closes preceding each signal.
+    return RollingReturns(closes).window_stats(signal_indices, minhistory)
+
+
+def profit_losses(closes, signal_indices, check_days):
+    # Relative price change check_days after each signal, or None when the
+    # future close is past the end of the data or the current close is zero.
+    signal_indices = np.asarray(signal_indices, dtype=np.int64)
+    future = signal_indices + check_days
+    current = closes[signal_indices]
+    valid = (future < len(closes)) & (current != 0)
+    change = np.zeros(len(signal_indices))
+    change[valid] = (closes[future[valid]] - current[valid]) / current[valid]
+    return [float(c) if ok else None for c, ok in zip(change.tolist(), valid.tolist())]
+
+
+def window_moments(asset_returns, signal_indices, minhistory):
+    # Mean vectors (signals, assets) and population covariance matrices
+    # (signals, assets, assets) of the asset returns built from
+    # closes[i - minhistory:i] for every signal i, the same window as
+    # RollingReturns.window_stats.
+    windows = np.lib.stride_tricks.sliding_window_view(asset_returns, minhistory - 1, axis=0)
+    windows = windows[np.asarray(signal_indices) - minhistory]
+    means = windows.mean(axis=2)
+    centred = windows - means[:, :, None]
+    covs = centred @ centred.transpose(0, 2, 1) / (minhistory - 1)
+    return means, covs
+
+
+def covariance_factors(covs):
+    # Batched lower Cholesky factors L with L @ L.T == cov. A tiny relative
+    # jitter absorbs rounding; rank-deficient windows (a flat asset, or more
+    # assets than returns) fall back to an eigendecomposition square root.
+    k = covs.shape[-1]
+    scale = np.trace(covs, axis1=1, axis2=2) / k
+    jitter = 1e-12 * np.where(scale > 0, scale, 1.0)
+    try:
+        return np.linalg.cholesky(covs + jitter[:, None, None] * np.eye(k))
+    except np.linalg.LinAlgError:
+        values, vectors = np.linalg.eigh(covs)
+        return vectors * np.sqrt(np.maximum(values, 0.0))[:, None, :]
+
+
+def simulate_portfolio_var(means, covs, weights, shots, rng=None):
+    # Correlated Monte Carlo for a basket. For every signal the asset returns
+    # are drawn as means + Z @ L.T with L the Cholesky factor of the window
+    # covariance, all signals of a batch in one (signals, shots, assets)
+    # tensor. Returns portfolio VaR95/VaR99 (signals,) and per-asset
+    # VaR95/VaR99 (signals, assets), read with the same tail rule as
+    # simulate_var.
+    rng = rng if rng is not None else np.random.default_rng()
+    means = np.asarray(means, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    n, k = means.shape
+    factors = covariance_factors(np.asarray(covs, dtype=np.float64))
+    var95, var99 = np.empty(n), np.empty(n)
+    asset95, asset99 = np.empty((n, k)), np.empty((n, k))
+
+    batch = max(1, MAX_BATCH_VALUES // max(1, shots * k))
+    for start in range(0, n, batch):
+        stop = min(start + batch, n)
+        simulated = rng.standard_normal((stop - start, shots, k)) @ factors[start:stop].transpose(0, 2, 1)
+        simulated += means[start:stop, None, :]
+        var95[start:stop], var99[start:stop] = tail_quantiles(simulated @ weights)
+        per_asset = simulated.transpose(0, 2, 1).reshape(-1, shots)
+        q95, q99 = tail_quantiles(per_asset)
+        asset95[start:stop], asset99[start:stop] = q95.reshape(-1, k), q99.reshape(-1, k)
+    return var95, var99, asset95, asset99
+
+
+def make_rng(seed=None, stream=0):
+    # Independent generator for one stream of a seed: shards (or signals,
+    # see signal_streams) of the same job share the seed entropy and differ
+    # in their spawn key, so their draws never overlap. Without a seed a
+    # fresh OS-entropy stream is used.
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng(np.random.SeedSequence(int(seed), spawn_key=(int(stream),)))
+
+
+def signal_streams(closes, signal_indices, minhistory, assets=None):
+    # Stream number of every signal, from the closes it is simulated from
+    # (its minhistory window and its own close, plus the asset closes of a
+    # basket). A signal's draws therefore do not depend on which shard,
+    # batch or row offset it lands in, only on the seed and its prices.
+    closes = np.ascontiguousarray(closes, dtype='<f8')
+    if assets is not None:
+        assets = np.ascontiguousarray(assets, dtype='<f8')
+    streams = []
+    for i in np.asarray(signal_indices, dtype=np.int64).tolist():
+        digest = hashlib.sha256(closes[i - minhistory:i + 1].tobytes())
+        if assets is not None:
+            digest.update(assets[i - minhistory:i + 1].tobytes())
+        streams.append(int(digest.hexdigest()[:16], 16))
+    return streams
+
+
+# Normal quantiles for the parametric method: the MC rule reads the value
+# with 5% (1%) of the draws above it, i.e. the 95th (99th) percentile
+Z95 = NormalDist().inv_cdf(0.95)
+Z99 = NormalDist().inv_cdf(0.99)
+
+# Registered VaR methods. Each takes the RollingReturns of the history, the
+# signal row indices, minhistory, shots and the RNG plus its own options and
+# returns (var95, var99, samples used) arrays, one entry per signal.
+VAR_METHODS = {}
+
+
+def register_var_method(name):
+    def decorator(func):
+        VAR_METHODS[name] = func
+        return func
+    return decorator
+
+
+@register_var_method('parametric')
+def parametric_var(rolling, signal_indices, minhistory, shots, rng):
+    # Closed form for the normal model the Monte Carlo method samples from.
+    means, stds = rolling.window_stats(signal_indices, minhistory)
+    return means + Z95 * stds, means + Z99 * stds, np.zeros(len(signal_indices), dtype=np.int64)
+
+
+@register_var_method('historical')
+def historical_var(rolling, signal_indices, minhistory, shots, rng):
+    # Same order statistics as the Monte Carlo method, read from the window's
+    # actual returns instead of simulated ones.
+    windows = np.lib.stride_tricks.sliding_window_view(rolling.returns, minhistory - 1)
+    var95, var99 = tail_quantiles(windows[np.asarray(signal_indices) - minhistory])
+    return var95, var99, np.full(len(signal_indices), minhistory - 1, dtype=np.int64)
+
+
+@register_var_method('montecarlo')
+def montecarlo_var(rolling, signal_indices, minhistory, shots, rng, sampling='plain', target_precision=None):
+    means, stds = rolling.window_stats(signal_indices, minhistory)
+    if sampling != 'plain' or target_precision is not None:
+        return simulate_var_adaptive(means, stds, shots, rng, sampling, target_precision)
+    var95, var99 = simulate_var(means, stds, shots, rng)
+    return var95, var99, np.full(len(signal_indices), shots, dtype=np.int64)
+
+
+def analysis_options(event):
+    # run_analysis keyword options from a worker payload, with defaults
+    method = event.get('method', 'montecarlo')
+    if method not in VAR_METHODS:
+        raise ValueError(f"Unknown VaR method: {method}")
+    options = {'method': method}
+    # Seeded Monte Carlo draws one stream per signal; shards that split the
+    # shots of a signal (sketch) keep the per-shard stream so their parts
+    # differ
+    if event.get('seed') is not None and not event.get('sketch') and (method == 'montecarlo' or event.get('weights') is not None):
+        options['signal_seed'] = int(event['seed'])
+    if event.get('weights') is not None:
+        # Basket payloads always use the correlated Monte Carlo kernel
+        options['weights'] = [float(weight) for weight in event['weights']]
+        return options
+    if method == 'montecarlo':
+        target_precision = event.get('target_precision')
+        options.update(
+            sketch=bool(event.get('sketch', False)),
+            sampling=event.get('sampling', 'plain'),
+            target_precision=float(target_precision) if target_precision is not None else None
+        )
+    return options
+
+
+# Signals evaluated per step when results are produced incrementally
+STREAM_CHUNK_SIGNALS = 64
+
+
+def iter_analysis(data, minhistory, shots, transaction_type, check_days, rng=None, start=None, stop=None, offset=0,
+                  method='montecarlo', sketch=False, chunk_signals=None, weights=None, signal_seed=None, **method_options):
+    # Shared simulation engine for the EC2 worker and the Lambda. Takes the
+    # payload data (columnar wire format or {Date, Close, Buy, Sell} rows,
+    # see payload.py) and yields one result per signal, evaluating
+    # chunk_signals signals at a time (all at once by default). Only signals
+    # with a row index in [start, stop) are evaluated, and `offset` is added
+    # to the reported signal_date when the rows are a slice of the full
+    # history. `method` picks the VaR method from VAR_METHODS and
+    # `method_options` are passed on to it; every result reports the samples
+    # it actually used. With `sketch` (Monte Carlo only) every result also
+    # carries its window mean/std and a mergeable quantile sketch of its
+    # draws (see sketch.py), so the coordinator can combine shards that split
+    # the shots of the same signal. With `weights` the data is a basket
+    # (Close is the portfolio index, Assets the asset closes): VaR comes from
+    # the correlated kernel and every result also carries the per-asset
+    # asset_var95/asset_var99 lists. With `signal_seed` every signal draws
+    # from its own stream of that seed (see signal_streams) instead of from
+    # `rng`, so its result is the same whatever the sharding.
+    if not data:
+        return
+    signal_type = transaction_type.capitalize()
+    columns = decode_data(data)
+    closes = columns['Close']
+    flags = columns[signal_type]
+    first = max(minhistory, start or 0)
+    last = len(closes) if stop is None else min(stop, len(closes))
+    all_indices = np.flatnonzero(flags[first:last] == 1) + first
+    if not len(all_indices):
+        return
+
+    rolling = RollingReturns(closes)
+    assets = None
+    if weights is not None:
+        assets = np.asarray(columns['Assets'], dtype=np.float64)
+        asset_returns = np.diff(assets, axis=0) / assets[:-1]
+
+    def simulate(signal_indices, rng):
+        # (var95, var99, shots used, per-signal extras) of some signals
+        if sketch:
+            means, stds = rolling.window_stats(signal_indices, minhistory)
+            counts = sketch_normal(len(signal_indices), shots, rng if rng is not None else np.random.default_rng())
+            var95, var99 = sketch_var(counts, means, stds)
+            return var95, var99, np.full(len(signal_indices), shots), {'mean': means, 'std': stds, 'counts': counts}
+        if weights is not None:
+            means, covs = window_moments(asset_returns, signal_indices, minhistory)
+            var95, var99, asset95, asset99 = simulate_portfolio_var(means, covs, weights, shots, rng)
+            return var95, var99, np.full(len(signal_indices), shots), {'asset95': asset95, 'asset99': asset99}
+        var95, var99, used = VAR_METHODS[method](rolling, signal_indices, minhistory, shots, rng, **method_options)
+        return var95, var99, used, {}
+
+    chunk_signals = chunk_signals or len(all_indices)
+    for chunk_start in range(0, len(all_indices), chunk_signals):
+        signal_indices = all_indices[chunk_start:chunk_start + chunk_signals]
+        if signal_seed is None:
+            var95, var99, used, extras = simulate(signal_indices, rng)
+        else:
+            streams = signal_streams(closes, signal_indices, minhistory, assets)
+            parts = [simulate(signal_indices[n:n + 1], make_rng(signal_seed, stream)) for n, stream in enumerate(streams)]
+            var95, var99, used = (np.concatenate([part[k] for part in parts]) for k in range(3))
+            extras = {name: np.concatenate([part[3][name] for part in parts]) for name in parts[0][3]}
+        pl = profit_losses(closes, signal_indices, check_days)
+
+        for n, i in enumerate(signal_indices.tolist()):
+            result = {
+                'signal_date': i + offset,
+                'var95': float(var95[n]),
+                'var99': float(var99[n]),
+                'profit_loss': pl[n],
+                'type': signal_type,
+                'shots': int(used[n])
+            }
+            if sketch:
+                result.update(mean=float(extras['mean'][n]), std=float(extras['std'][n]), sketch=encode_counts(extras['counts'][n]))
+            if weights is not None:
+                result.update(asset_var95=extras['asset95'][n].tolist(), asset_var99=extras['asset99'][n].tolist())
+            yield result
+
+
+def summarize_analysis(results):
+    # The averages block the workers report alongside their results
+    count_signals = len(results)
+    return {
+        'average_var95': sum(result['var95'] for result in results) / count_signals if count_signals else 0,
+        'average_var99': sum(result['var99'] for result in results) / count_signals if count_signals else 0,
+        'total_profit_loss': sum(result['profit_loss'] for result in results if result['profit_loss'])
+    }
+
+
+def run_analysis(data, minhistory, shots, transaction_type, check_days, rng=None, start=None, stop=None, offset=0, **options):
+    # All results of iter_analysis at once, together with their averages.
+    results = list(iter_analysis(data, minhistory, shots, transaction_type, check_days, rng, start, stop, offset, **options))
+    return results, summarize_analysis(results)
+
+
+def run_sweep(data, grid, rng=None):
+    # Evaluates the Cartesian grid of h (minhistory), d (shots), t and p
+    # (check_days) values over one price history. The returns and their
+    # prefix sums are built once, each (t, h) pair is simulated once with
+    # the largest d (smaller d reuse a prefix of the draws), and p only
+    # changes the profit/loss read-out. Returns one aggregate row per
+    # combination.
+    columns = decode_data(data)
+    closes = columns['Close']
+    rolling = RollingReturns(closes)
+    table = []
+    for transaction_type in grid.get('t', ['buy']):
+        signal_type = transaction_type.capitalize()
+        flags = columns[signal_type]
+        for minhistory in grid.get('h', [101]):
+            minhistory = int(minhistory)
+            signal_indices = np.flatnonzero(flags[minhistory:] == 1) + minhistory
+            means, stds = rolling.window_stats(signal_indices, minhistory)
+            simulated = simulate_var_multi(means, stds, grid.get('d', [10000]), rng)
+            pls = {int(p): profit_losses(closes, signal_indices, int(p)) for p in grid.get('p', [7])}
+            for shots, (var95, var99) in simulated.items():
+                count_signals = len(signal_indices)
+                for check_days, pl in pls.items():
+                    table.append({
+                        'h': minhistory,
+                        'd': shots,
+                        't': transaction_type,
+                        'p': check_days,
+                        'signals': count_signals,
+                        'average_var95': float(var95.mean()) if count_signals else 0,
+                        'average_var99': float(var99.mean()) if count_signals else 0,
+                        'total_profit_loss': sum(v for v in pl if v)
+                    })
+    return table
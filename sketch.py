@@ -0,0 +1,87 @@
+import base64
+import zlib
+import numpy as np
+
+# Mergeable fixed-bin histogram sketches of simulated returns, one per signal.
+#
+# Samples are standardised with the signal's window mean and std (every shard
+# of a signal sees the same window, so all shards use identical bins) and
+# counted into BINS equal bins over [-Z_RANGE, Z_RANGE], plus one underflow
+# and one overflow bin. Merging is adding counts, so it is exact and
+# order-independent, and a sketch takes O(BINS) memory however many shots
+# are streamed into it.
+#
+# Error bound: a quantile read from a sketch lies in the same bin as the exact
+# order statistic of the merged samples (the original "sort descending, take
+# index int(n * q)" rule), so it is within one bin width,
+# 2 * Z_RANGE / BINS = 0.0117 std, of the exact value. That is about half the
+# Monte Carlo standard error of VaR95 at 10000 shots (~0.021 std). The
+# guarantee only fails if the order statistic is beyond +/-Z_RANGE std
+# (probability < 1e-8 per sample), in which case the range edge is returned.
+BINS = 1024
+Z_RANGE = 6.0
+WIDTH = 2 * Z_RANGE / BINS
+
+# Bound on the samples standardised at once while streaming into sketches
+MAX_BATCH_VALUES = 4_000_000
+
+
+def empty_counts(n_signals):
+    return np.zeros((n_signals, BINS + 2), dtype=np.int64)
+
+
+def add_samples(counts, z_samples):
+    # Adds a (signals x samples) matrix of standardised samples to counts in
+    # place. Column 0 is the underflow bin and column BINS + 1 the overflow.
+    bins = np.floor((z_samples + Z_RANGE) / WIDTH).astype(np.int64) + 1
+    np.clip(bins, 0, BINS + 1, out=bins)
+    rows = np.arange(len(counts))[:, None] * (BINS + 2)
+    counts += np.bincount((bins + rows).ravel(), minlength=counts.size).reshape(counts.shape)
+    return counts
+
+
+def sketch_normal(n_signals, shots, rng):
+    # Streams `shots` standard normal draws per signal into fresh sketches,
+    # in batches so memory stays bounded for any shot count.
+    counts = empty_counts(n_signals)
+    if n_signals == 0:
+        return counts
+    batch = max(1, MAX_BATCH_VALUES // n_signals)
+    for start in range(0, shots, batch):
+        add_samples(counts, rng.standard_normal((n_signals, min(batch, shots - start))))
+    return counts
+
+
+def upper_tail_quantile(counts, tail):
+    # Standardised value at descending index int(n * tail) of each row, i.e.
+    # the same order statistic tail_quantiles reads from raw samples, with
+    # linear interpolation inside its bin.
+    totals = counts.sum(axis=1)
+    ranks = totals - 1 - (totals * tail).astype(np.int64)
+    cumulative = np.cumsum(counts, axis=1)
+    bins = np.array([np.searchsorted(row, rank, side='right') for row, rank in zip(cumulative, ranks)], dtype=np.int64)
+    before = np.where(bins > 0, cumulative[np.arange(len(counts)), np.maximum(bins - 1, 0)], 0)
+    inside = counts[np.arange(len(counts)), bins]
+    fraction = (ranks - before + 0.5) / np.maximum(inside, 1)
+    z = -Z_RANGE + (bins - 1 + fraction) * WIDTH
+    z = np.where(bins == 0, -Z_RANGE, z)
+    z = np.where(bins == BINS + 1, Z_RANGE, z)
+    return np.where(totals > 0, z, np.nan)
+
+
+def sketch_var(counts, means, stds):
+    # VaR95 and VaR99 from sketches in the units of the simulated returns.
+    return means + stds * upper_tail_quantile(counts, 0.05), means + stds * upper_tail_quantile(counts, 0.01)
+
+
+def encode_counts(counts):
+    # Compact JSON-safe form of one signal's counts: zlib-compressed uint32
+    # (uint64 when a bin overflows 32 bits), base64-encoded.
+    counts = np.asarray(counts)
+    dtype = '<u4' if counts.max(initial=0) < 2 ** 32 else '<u8'
+    return {'dtype': dtype, 'counts': base64.b64encode(zlib.compress(counts.astype(dtype).tobytes())).decode('ascii')}
+
+
+def decode_counts(encoded):
+    raw = zlib.decompress(base64.b64decode(encoded['counts']))
+    return np.frombuffer(raw, dtype=encoded['dtype']).astype(np.int64)
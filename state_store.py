@@ -0,0 +1,266 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Shared API state (warmed-up services, latest results, audit log, job
+# status) behind one interface, so any number of gunicorn processes and
+# threads see the same state. Values are JSON documents. Backends:
+#   memory            single process (the default)
+#   sqlite:<path>     processes on one host
+#   redis://<host>    processes on many hosts (needs the redis package)
+
+
+class StateStore:
+    # Key/value operations every backend implements. update() is an atomic
+    # read-modify-write; push()/items() keep append-only lists.
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def update(self, key, func, default=None):
+        raise NotImplementedError
+
+    def push(self, key, item):
+        raise NotImplementedError
+
+    def items(self, key):
+        raise NotImplementedError
+
+    def lock(self, name, timeout=30):
+        raise NotImplementedError
+
+    def namespace(self, name):
+        return NamespacedState(self, name)
+
+
+class NamespacedState:
+    # View of a store with every key prefixed by '<name>:', used for
+    # per-session and per-job state.
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def key(self, key):
+        return f'{self.name}:{key}'
+
+    def get(self, key, default=None):
+        return self.store.get(self.key(key), default)
+
+    def set(self, key, value):
+        self.store.set(self.key(key), value)
+
+    def delete(self, key):
+        self.store.delete(self.key(key))
+
+    def update(self, key, func, default=None):
+        return self.store.update(self.key(key), func, default)
+
+    def push(self, key, item):
+        self.store.push(self.key(key), item)
+
+    def items(self, key):
+        return self.store.items(self.key(key))
+
+    def lock(self, name, timeout=30):
+        return self.store.lock(self.key(name), timeout)
+
+    def namespace(self, name):
+        return NamespacedState(self.store, self.key(name))
+
+
+class MemoryStateStore(StateStore):
+    def __init__(self):
+        self.values = {}
+        self.lists = {}
+        self.mutex = threading.RLock()
+        self.locks = {}
+
+    def get(self, key, default=None):
+        with self.mutex:
+            value = self.values.get(key)
+        return json.loads(value) if value is not None else default
+
+    def set(self, key, value):
+        with self.mutex:
+            self.values[key] = json.dumps(value)
+
+    def delete(self, key):
+        with self.mutex:
+            self.values.pop(key, None)
+            self.lists.pop(key, None)
+
+    def update(self, key, func, default=None):
+        with self.mutex:
+            value = func(self.get(key, default))
+            self.set(key, value)
+            return value
+
+    def push(self, key, item):
+        with self.mutex:
+            self.lists.setdefault(key, []).append(json.dumps(item))
+
+    def items(self, key):
+        with self.mutex:
+            return [json.loads(item) for item in self.lists.get(key, [])]
+
+    @contextmanager
+    def lock(self, name, timeout=30):
+        with self.mutex:
+            lock = self.locks.setdefault(name, threading.Lock())
+        if not lock.acquire(timeout=timeout):
+            raise TimeoutError(f"Could not acquire state lock {name}")
+        try:
+            yield
+        finally:
+            lock.release()
+
+
+class SQLiteStateStore(StateStore):
+    # One SQLite file shared by all processes on the host. Each thread gets
+    # its own connection; writes use IMMEDIATE transactions so concurrent
+    # read-modify-writes serialise on the database lock.
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self.transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS lists (seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, value TEXT NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS lists_key ON lists (key, seq)')
+            conn.execute('CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)')
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def get(self, key, default=None):
+        row = self.connection().execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def delete(self, key):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+            conn.execute('DELETE FROM lists WHERE key = ?', (key,))
+
+    def update(self, key, func, default=None):
+        with self.transaction() as conn:
+            row = conn.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+            value = func(json.loads(row[0]) if row else default)
+            conn.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+            return value
+
+    def push(self, key, item):
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO lists (key, value) VALUES (?, ?)', (key, json.dumps(item)))
+
+    def items(self, key):
+        rows = self.connection().execute('SELECT value FROM lists WHERE key = ? ORDER BY seq', (key,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    @contextmanager
+    def lock(self, name, timeout=30):
+        owner = uuid.uuid4().hex
+        deadline = time.time() + timeout
+        while True:
+            with self.transaction() as conn:
+                now = time.time()
+                conn.execute('DELETE FROM locks WHERE name = ? AND expires < ?', (name, now))
+                acquired = conn.execute('INSERT OR IGNORE INTO locks (name, owner, expires) VALUES (?, ?, ?)',
+                                        (name, owner, now + timeout)).rowcount == 1
+            if acquired:
+                break
+            if time.time() > deadline:
+                raise TimeoutError(f"Could not acquire state lock {name}")
+            time.sleep(0.05)
+        try:
+            yield
+        finally:
+            with self.transaction() as conn:
+                conn.execute('DELETE FROM locks WHERE name = ? AND owner = ?', (name, owner))
+
+
+class RedisStateStore(StateStore):
+    # Works with any Redis-protocol server; update() is an optimistic
+    # WATCH/MULTI loop and lock() uses the client's lease-based lock.
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key, default=None):
+        value = self.client.get(key)
+        return json.loads(value) if value is not None else default
+
+    def set(self, key, value):
+        self.client.set(key, json.dumps(value))
+
+    def delete(self, key):
+        self.client.delete(key, f'{key}:list')
+
+    def update(self, key, func, default=None):
+        import redis
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    current = pipe.get(key)
+                    value = func(json.loads(current) if current is not None else default)
+                    pipe.multi()
+                    pipe.set(key, json.dumps(value))
+                    pipe.execute()
+                    return value
+                except redis.WatchError:
+                    continue
+
+    def push(self, key, item):
+        self.client.rpush(f'{key}:list', json.dumps(item))
+
+    def items(self, key):
+        return [json.loads(item) for item in self.client.lrange(f'{key}:list', 0, -1)]
+
+    @contextmanager
+    def lock(self, name, timeout=30):
+        with self.client.lock(f'lock:{name}', timeout=timeout, blocking_timeout=timeout):
+            yield
+
+
+def open_state_store(spec=None):
+    # Backend from STATE_BACKEND: 'memory', 'sqlite:<path>' or 'redis://...'
+    spec = spec or os.environ.get('STATE_BACKEND', 'memory')
+    if spec == 'memory':
+        return MemoryStateStore()
+    if spec.startswith('sqlite:'):
+        return SQLiteStateStore(spec[len('sqlite:'):])
+    if spec.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStateStore(spec)
+    raise ValueError(f"Unknown state backend: {spec}")
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from memo import SimulationMemo, signal_keys
+from partition import merge_shard_results, plan_shards, signal_indices
+from simulation import analysis_options, make_rng, run_analysis
+
+MINHISTORY, SHOTS, CHECK_DAYS, SEED = 21, 2000, 7, 11
+
+
+def price_columns(n, seed=0):
+    # Columns as payload.columns_from_frame builds them, with random signals
+    rng = np.random.default_rng(seed)
+    return {
+        'Date': np.arange(n, dtype='<i4'),
+        'Close': 100.0 * np.exp(np.cumsum(rng.normal(0.0005, 0.02, n))),
+        'Buy': (rng.random(n) < 0.3).astype(np.uint8),
+        'Sell': (rng.random(n) < 0.3).astype(np.uint8)
+    }
+
+
+def run_job(columns, n_workers, seed=SEED, indices=None, **options):
+    # Plans a job and runs every shard the way the workers do
+    shards = plan_shards(columns, MINHISTORY, SHOTS, 'buy', CHECK_DAYS, n_workers, seed=seed, options=options,
+                         indices=indices)
+    shard_results = []
+    for shard in shards:
+        results, _ = run_analysis(shard['data'], shard['minhistory'], shard['shots'], shard['t'], shard['p'],
+                                  make_rng(shard['seed'], shard['stream']), shard['start'], shard['stop'],
+                                  shard['offset'], **analysis_options(shard))
+        shard_results.append((results, shard['shots']))
+    return merge_shard_results(shard_results)
+
+
+def assert_rows_close(rows, expected):
+    # Same signals and draws; window stats come from prefix sums over each
+    # shard's own rows, so VaR may differ in the last bits
+    assert [(row['signal_date'], row['shots'], row['profit_loss']) for row in rows] == \
+        [(row['signal_date'], row['shots'], row['profit_loss']) for row in expected]
+    for field in ('var95', 'var99'):
+        np.testing.assert_allclose([row[field] for row in rows], [row[field] for row in expected], rtol=1e-12)
+
+
+def test_repeat_request_served_from_memo():
+    columns = price_columns(300)
+    indices = signal_indices(columns, MINHISTORY, 'buy').tolist()
+    keys = signal_keys(columns, indices, MINHISTORY, SHOTS, 'buy', CHECK_DAYS, seed=SEED)
+    rows = run_job(columns, 3)
+    memo = SimulationMemo()
+    memo.store('series', keys, rows)
+
+    hits = memo.lookup('series', keys)
+    assert [hits[key] for key in keys] == rows
+    assert memo.lookup('series', signal_keys(columns, indices, MINHISTORY, SHOTS, 'buy', CHECK_DAYS, seed=SEED + 1)) == {}
+
+
+def test_trailing_days_only_simulate_new_signals():
+    columns = price_columns(320)
+    old = {name: values[:300] for name, values in columns.items()}
+    old_indices = signal_indices(old, MINHISTORY, 'buy').tolist()
+    memo = SimulationMemo()
+    memo.store('series', signal_keys(old, old_indices, MINHISTORY, SHOTS, 'buy', CHECK_DAYS, seed=SEED), run_job(old, 2))
+
+    indices = signal_indices(columns, MINHISTORY, 'buy').tolist()
+    keys = signal_keys(columns, indices, MINHISTORY, SHOTS, 'buy', CHECK_DAYS, seed=SEED)
+    hits = memo.lookup('series', keys)
+    # Signals whose profit window ended before the old last day are reused,
+    # the ones that reached it or are new are not
+    assert {i for i, key in zip(indices, keys) if key in hits} == {i for i in old_indices if i + CHECK_DAYS < 300}
+
+    # Simulating only the misses gives the rows of a full run
+    missing = [i for i, key in zip(indices, keys) if key not in hits]
+    fresh = {row['signal_date']: row for row in run_job(columns, 2, indices=np.array(missing))}
+    merged = [hits[key] if key in hits else fresh[i] for i, key in zip(indices, keys)]
+    assert_rows_close(merged, run_job(columns, 2))
+
+
+@pytest.mark.parametrize('options', [{}, {'sampling': 'antithetic'}, {'method': 'historical'}])
+def test_seeded_results_do_not_depend_on_worker_count(options):
+    columns = price_columns(400, seed=3)
+    single = run_job(columns, 1, **options)
+    assert len(single) > 10
+    for n_workers in (3, 7, 200):
+        assert_rows_close(run_job(columns, n_workers, **options), single)
+    if 'method' not in options:
+        other = run_job(columns, 3, seed=SEED + 1, **options)
+        assert not np.allclose([row['var95'] for row in other], [row['var95'] for row in single], rtol=1e-6)
@@ -0,0 +1,113 @@
+import json
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+import index
+from scheduler import ShardScheduler, forget_health
+
+
+@pytest.fixture(autouse=True)
+def fresh_health():
+    # Instance health is kept across jobs; every test starts without any
+    forget_health()
+    yield
+    forget_health()
+
+
+def run_collecting(scheduler, shards):
+    # Runs the shards and returns the report and the (shard, instance)
+    # deliveries in the order on_result saw them
+    delivered = []
+    lock = threading.Lock()
+
+    def on_result(shard, outcome, instance_id, seconds):
+        with lock:
+            delivered.append((shard, instance_id))
+
+    return scheduler.run(shards, on_result), delivered
+
+
+def test_flaky_instance_is_retried_elsewhere():
+    def call(instance_id, shard):
+        if instance_id == 'flaky':
+            raise IOError('connection reset')
+        return [shard]
+
+    report, delivered = run_collecting(ShardScheduler(['flaky', 'good'], call), range(6))
+    assert report['failed'] == []
+    assert report['retries'] >= 1
+    assert sorted(shard for shard, _ in delivered) == list(range(6))
+    assert {instance_id for _, instance_id in delivered} == {'good'}
+
+
+class StreamResponse:
+    # The parts of a streamed requests.Response that post_ec2_shard uses
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+
+class StreamSession:
+    # Serves every shard as an NDJSON stream of one row; the host named
+    # 'truncated' stops before the trailer line
+
+    def post(self, url, **kwargs):
+        lines = [json.dumps({'signal_date': kwargs['json']['start'], 'var95': 0.1}).encode()]
+        if 'truncated' not in url:
+            lines.append(json.dumps({'averages': {}, 'timings': {'total': 0.0}}).encode())
+        return StreamResponse(lines)
+
+
+def test_truncated_stream_counts_as_failure():
+    session = StreamSession()
+    scheduler = ShardScheduler(['truncated', 'complete'],
+                               lambda instance_id, payload: index.post_ec2_shard(session, instance_id, payload),
+                               rows=lambda outcome: len(outcome[0]))
+    report, delivered = run_collecting(scheduler, [{'start': n} for n in range(4)])
+    assert report['failed'] == []
+    assert report['retries'] >= 1
+    assert sorted(shard['start'] for shard, _ in delivered) == list(range(4))
+    assert {instance_id for _, instance_id in delivered} == {'complete'}
+
+
+def test_hedged_shard_is_delivered_once():
+    def call(instance_id, shard):
+        time.sleep(0.5 if instance_id == 'slow' else 0.01)
+        return [shard]
+
+    scheduler = ShardScheduler(['slow', 'fast'], call, hedge_min_completed=3)
+    report, delivered = run_collecting(scheduler, range(8))
+    # The losing attempt returns after run() and must be dropped
+    time.sleep(0.6)
+    assert report['hedges'] >= 1
+    assert report['failed'] == []
+    assert Counter(shard for shard, _ in delivered) == Counter(range(8))
+
+
+def test_shards_failing_every_attempt_are_reported():
+    calls = Counter()
+
+    def call(instance_id, shard):
+        calls[shard] += 1
+        raise IOError('worker down')
+
+    delivered = []
+    report = ShardScheduler(['a', 'b'], call, max_attempts=3).run(range(2), lambda *args: delivered.append(args))
+    assert report['failed'] == [0, 1]
+    assert delivered == []
+    assert calls == {0: 3, 1: 3}
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from simulation import RollingReturns, window_stats
+
+
+def loop_window_stats(closes, end_indices, minhistory):
+    # The original per-signal definition: returns of closes[i - minhistory:i]
+    # and their mean and population std
+    means, stds = [], []
+    for i in end_indices:
+        close_prices = [closes[j] for j in range(i - minhistory, i)]
+        returns = [(close_prices[k] - close_prices[k - 1]) / close_prices[k - 1] for k in range(1, len(close_prices))]
+        mean = sum(returns) / len(returns)
+        means.append(mean)
+        stds.append((sum((x - mean) ** 2 for x in returns) / len(returns)) ** 0.5)
+    return np.array(means), np.array(stds)
+
+
+def gbm_closes(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return 100.0 * np.exp(np.cumsum(rng.normal(0.0005, 0.02, n)))
+
+
+@pytest.mark.parametrize('minhistory', [2, 3, 21, 101, 250])
+def test_window_stats_matches_loop(minhistory):
+    closes = gbm_closes(600)
+    end_indices = np.arange(minhistory, len(closes))
+    means, stds = window_stats(closes, end_indices, minhistory)
+    expected_means, expected_stds = loop_window_stats(closes.tolist(), end_indices.tolist(), minhistory)
+    np.testing.assert_allclose(means, expected_means, rtol=1e-9, atol=1e-15)
+    np.testing.assert_allclose(stds, expected_stds, rtol=1e-7, atol=1e-12)
+
+
+def test_window_stats_two_closes_has_zero_std():
+    # h=2 is a single return: its mean is that return and its std is zero
+    closes = gbm_closes(50, seed=1)
+    end_indices = np.arange(2, len(closes))
+    means, stds = RollingReturns(closes).window_stats(end_indices, 2)
+    np.testing.assert_allclose(means, (closes[1:-1] - closes[:-2]) / closes[:-2], rtol=1e-9)
+    assert np.all(stds < 1e-12)
+
+
+def test_window_stats_flat_prices():
+    closes = np.full(200, 50.0)
+    means, stds = window_stats(closes, np.arange(101, 200), 101)
+    assert np.all(means == 0.0)
+    assert np.all(stds == 0.0)
+
+
+def test_window_stats_large_price_level():
+    # Prefix sums stay accurate for small returns on a large price level
+    closes = 1e6 + np.cumsum(np.random.default_rng(2).normal(0, 1, 3000))
+    end_indices = np.arange(101, len(closes), 7)
+    means, stds = window_stats(closes, end_indices, 101)
+    expected_means, expected_stds = loop_window_stats(closes.tolist(), end_indices.tolist(), 101)
+    np.testing.assert_allclose(means, expected_means, rtol=1e-6, atol=1e-15)
+    np.testing.assert_allclose(stds, expected_stds, rtol=1e-6)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from partition import merge_shard_results
+from simulation import tail_quantiles
+from sketch import WIDTH, add_samples, empty_counts, encode_counts
+
+
+def shard_rows(z_samples, means, stds):
+    # Result rows of one shard that drew z_samples (signals x shots) for the
+    # signals, as iter_analysis reports them with sketch=True
+    counts = add_samples(empty_counts(len(means)), z_samples)
+    return [{'signal_date': n, 'type': 'Buy', 'var95': 0.0, 'var99': 0.0, 'profit_loss': None,
+             'mean': float(means[n]), 'std': float(stds[n]), 'sketch': encode_counts(counts[n])}
+            for n in range(len(means))]
+
+
+@pytest.mark.parametrize('shot_parts', [[10000], [5000, 5000], [3334, 3333, 3333], [1, 999, 4000, 5000]])
+def test_merged_sketch_within_one_bin_of_exact(shot_parts):
+    rng = np.random.default_rng(sum(shot_parts) + len(shot_parts))
+    n_signals = 20
+    means = rng.normal(0.0, 0.002, n_signals)
+    stds = rng.uniform(0.005, 0.05, n_signals)
+    parts = [rng.standard_normal((n_signals, shots)) for shots in shot_parts]
+
+    merged = merge_shard_results([(shard_rows(z, means, stds), shots) for z, shots in zip(parts, shot_parts)])
+    exact95, exact99 = tail_quantiles(means[:, None] + stds[:, None] * np.hstack(parts))
+
+    var95 = np.array([row['var95'] for row in merged])
+    var99 = np.array([row['var99'] for row in merged])
+    assert len(merged) == n_signals
+    assert np.all(np.abs(var95 - exact95) <= WIDTH * stds + 1e-12)
+    assert np.all(np.abs(var99 - exact99) <= WIDTH * stds + 1e-12)
+    assert all('sketch' not in row and 'mean' not in row for row in merged)
+
+
+def test_merge_is_order_independent():
+    rng = np.random.default_rng(7)
+    means, stds = np.zeros(5), np.ones(5)
+    shards = [(shard_rows(rng.standard_normal((5, shots)), means, stds), shots) for shots in (100, 2000, 700)]
+    forward = merge_shard_results(shards)
+    backward = merge_shard_results(shards[::-1])
+    assert [row['var95'] for row in forward] == [row['var95'] for row in backward]
+    assert [row['var99'] for row in forward] == [row['var99'] for row in backward]
@@ -0,0 +1,105 @@
+import threading
+
+import pytest
+
+from state_store import MemoryStateStore, SQLiteStateStore
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    # Every backend that runs without a server has to pass the same contract
+    if request.param == 'memory':
+        return MemoryStateStore()
+    return SQLiteStateStore(str(tmp_path / 'state.db'))
+
+
+def run_threads(target, n_threads=2):
+    threads = [threading.Thread(target=target) for _ in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_get_set_delete(store):
+    assert store.get('missing') is None
+    assert store.get('missing', {'a': 1}) == {'a': 1}
+    store.set('key', {'nested': [1, 2.5, 'x', None]})
+    assert store.get('key') == {'nested': [1, 2.5, 'x', None]}
+    store.set('key', 3)
+    assert store.get('key') == 3
+    store.delete('key')
+    assert store.get('key') is None
+
+
+def test_update_returns_new_value(store):
+    assert store.update('counter', lambda value: value + 1, 0) == 1
+    assert store.update('counter', lambda value: value + 1, 0) == 2
+    assert store.get('counter') == 2
+
+
+def test_push_keeps_order_and_delete_clears_it(store):
+    for n in range(5):
+        store.push('log', {'n': n})
+    assert store.items('log') == [{'n': n} for n in range(5)]
+    assert store.items('other') == []
+    store.delete('log')
+    assert store.items('log') == []
+
+
+def test_namespaces_are_separate(store):
+    store.namespace('a').set('key', 1)
+    store.namespace('b').set('key', 2)
+    assert store.namespace('a').get('key') == 1
+    assert store.namespace('a').namespace('c').get('key') is None
+    assert store.get('a:key') == 1
+
+
+def test_concurrent_updates_and_pushes_are_not_lost(store):
+    def work():
+        for _ in range(100):
+            store.update('counter', lambda value: value + 1, 0)
+            store.push('log', 1)
+
+    run_threads(work)
+    assert store.get('counter') == 200
+    assert len(store.items('log')) == 200
+
+
+def test_lock_excludes_other_threads(store):
+    inside = []
+    overlaps = []
+
+    def work():
+        for _ in range(20):
+            with store.lock('job', timeout=10):
+                inside.append(1)
+                if len(inside) > 1:
+                    overlaps.append(1)
+                inside.pop()
+
+    run_threads(work)
+    assert overlaps == []
+
+
+def test_lock_times_out_while_held(store):
+    held = threading.Event()
+    release = threading.Event()
+
+    def holder():
+        with store.lock('job', timeout=10):
+            held.set()
+            release.wait(10)
+
+    thread = threading.Thread(target=holder)
+    thread.start()
+    try:
+        assert held.wait(10)
+        with pytest.raises(TimeoutError):
+            with store.lock('job', timeout=0.2):
+                pass
+    finally:
+        release.set()
+        thread.join()
+    with store.lock('job', timeout=1):
+        pass